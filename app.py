@@ -3,139 +3,423 @@ from flask import (
     request,
     render_template,
     Response,
-    stream_with_context,
     Blueprint,
+    send_file,
+    send_from_directory,
 )
 import asyncio
-import os
+import concurrent.futures
+import io
 import json
-import base64
-import queue
+import os
+import mimetypes
+import secrets
 import threading
-from datetime import datetime
+import time
+from typing import Any, Awaitable, Callable
 
-from computer_use_demo.loop import sampling_loop, APIProvider
-from computer_use_demo.tools import ToolResult
-from anthropic.types.beta import BetaMessage, BetaMessageParam
-from anthropic import APIResponse
+from computer_use_demo import metrics
+from computer_use_demo.image_store import ImageStore
+from computer_use_demo.loop import sampling_loop, APIProvider, SamplingResponse
+from computer_use_demo.sessions import Session, SessionStore
+from computer_use_demo.tools import ComputerTool, ToolCollection, ToolResult
+from anthropic.types.beta import (
+    BetaContentBlock,
+    BetaMessageParam,
+    BetaTextDelta,
+)
 
 app = Flask(__name__)
 
-add_app = Blueprint(
-    "screenshots",
-    __name__,
-    static_url_path="/screenshots",
-    static_folder="./screenshots",
-)
+add_app = Blueprint("screenshots", __name__, url_prefix="/screenshots")
+image_store = ImageStore(os.path.join(app.root_path, "screenshots"))
+# content-addressed images never change, so browsers may cache them for good
+IMAGE_MAX_AGE = 365 * 24 * 60 * 60  # seconds
+
+
+@add_app.route("/<path:filename>")
+def screenshot(filename: str):
+    image = image_store.get(filename)
+    if image is None:
+        # screenshots saved before images were content-addressed
+        return send_from_directory(image_store.directory, filename)
+    response = send_file(
+        image if isinstance(image, str) else io.BytesIO(image),
+        mimetype=mimetypes.guess_type(filename)[0],
+        etag=image_store.etag(filename),
+        max_age=IMAGE_MAX_AGE,
+        conditional=True,
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
 app.register_blueprint(add_app)
 
+# all runs drive the same screen, so they take turns; a few more may wait in line
+MAX_ACTIVE_RUNS = 1
+MAX_WAITING_RUNS = 4
+# conversations are kept for follow-up instructions until they have been idle this long
+SESSION_IDLE_TIMEOUT = 30 * 60  # seconds
+MAX_SESSIONS = 16
+# events of finished runs are kept this long for clients to catch up on
+RUN_EVENTS_RETENTION = 10 * 60  # seconds
+SSE_KEEPALIVE_INTERVAL = 15.0  # seconds
+# with TRACE_DIR set, each run writes a timeline of where its time went to
+# <TRACE_DIR>/<session id>_<run id>.json, to be opened in Perfetto
+TRACE_DIR = os.getenv("TRACE_DIR")
+
+
+class Runner:
+    """
+    Runs sampling loops on a single long-lived event loop thread, so API clients
+    and the computer tool are set up once and shared by all runs, and sessions'
+    shells live on between runs. At most `max_active` runs execute at a time and
+    up to `max_waiting` more wait their turn; `submit` turns away anything beyond
+    that. Expired sessions are closed once a minute.
+    """
+
+    _expire_interval = 60.0  # seconds
+
+    def __init__(self, max_active: int, max_waiting: int, sessions: SessionStore):
+        self.max_active = max_active
+        self.max_waiting = max_waiting
+        self.sessions = sessions
+        self._loop = asyncio.new_event_loop()
+        self._slots = asyncio.Semaphore(max_active)
+        self._admitted = 0
+        self._admitted_lock = threading.Lock()
+        # queue position callbacks of the waiting runs, in order
+        self._waiting: list[Callable[[int], None]] = []
+        self._computer: ComputerTool | None = None
+        threading.Thread(
+            target=self._loop.run_forever, name="sampling-loop", daemon=True
+        ).start()
+        self._loop.call_soon_threadsafe(self._expire_sessions)
+
+    def submit(
+        self,
+        session: Session,
+        run: Callable[[ToolCollection], Awaitable[Any]],
+        on_queue_position: Callable[[int], None],
+    ) -> concurrent.futures.Future | None:
+        """
+        Schedule `run` with the session's tools, or return None if the queue is
+        full. `on_queue_position` is told the run's position while it waits.
+        """
+        with self._admitted_lock:
+            if self._admitted >= self.max_active + self.max_waiting:
+                return None
+            self._admitted += 1
+        return asyncio.run_coroutine_threadsafe(
+            self._run(session, run, on_queue_position), self._loop
+        )
+
+    async def _run(self, session, run, on_queue_position):
+        self._waiting.append(on_queue_position)
+        if self._slots.locked():
+            on_queue_position(len(self._waiting))
+        try:
+            async with self._slots:
+                self._leave_queue(on_queue_position)
+                if self._computer is None:
+                    self._computer = ComputerTool()
+                self._computer.reset()
+                return await run(session.tool_collection(self._computer))
+        finally:
+            # cancelled while still waiting
+            if on_queue_position in self._waiting:
+                self._leave_queue(on_queue_position)
+            with self._admitted_lock:
+                self._admitted -= 1
+
+    def _leave_queue(self, on_queue_position):
+        self._waiting.remove(on_queue_position)
+        for position, notify in enumerate(self._waiting, 1):
+            notify(position)
+
+    def _expire_sessions(self):
+        for session in self.sessions.expire():
+            session.close()
+        self._loop.call_later(self._expire_interval, self._expire_sessions)
+
+
+class EventLog:
+    """
+    The events of one run, formatted as Server-Sent Events. They are kept after the
+    run ends so that a client that reconnects can resume after the last event it
+    received; event ids are positions in the log, starting at 1.
+    """
+
+    def __init__(self, run_id: str):
+        self.id = run_id
+        self.finished_at: float | None = None
+        self._events: list[str] = []
+        self._changed = threading.Condition()
+
+    def emit(self, event_type: str, **data):
+        with self._changed:
+            event_id = len(self._events) + 1
+            self._events.append(
+                f"id: {event_id}\nevent: {event_type}\n"
+                f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+            )
+            self._changed.notify_all()
+
+    def close(self, status: str, **data):
+        """Emit the final `done` event."""
+        self.emit("done", status=status, **data)
+        with self._changed:
+            self.finished_at = time.monotonic()
+            self._changed.notify_all()
+
+    def wait(self, after: int, timeout: float) -> tuple[list[str], bool]:
+        """
+        Wait until there are events after the first `after`, or the run has finished,
+        and return those events along with whether it has finished.
+        """
+        with self._changed:
+            self._changed.wait_for(
+                lambda: len(self._events) > after or self.finished_at is not None,
+                timeout,
+            )
+            return self._events[after:], self.finished_at is not None
+
+
+class RunRegistry:
+    """Event logs of the current and recently finished runs, by run id."""
+
+    def __init__(self, retention: float):
+        self.retention = retention
+        self._runs: dict[str, EventLog] = {}
+        self._lock = threading.Lock()
+
+    def start(self) -> EventLog:
+        events = EventLog(secrets.token_urlsafe(16))
+        now = time.monotonic()
+        with self._lock:
+            for run_id, old in list(self._runs.items()):
+                if (
+                    old.finished_at is not None
+                    and now - old.finished_at > self.retention
+                ):
+                    del self._runs[run_id]
+            self._runs[events.id] = events
+        return events
+
+    def get(self, run_id: str) -> EventLog | None:
+        with self._lock:
+            return self._runs.get(run_id)
+
+
+runs = RunRegistry(retention=RUN_EVENTS_RETENTION)
+runner = Runner(
+    MAX_ACTIVE_RUNS,
+    MAX_WAITING_RUNS,
+    SessionStore(idle_timeout=SESSION_IDLE_TIMEOUT, max_sessions=MAX_SESSIONS),
+)
+
 
 @app.route("/", methods=["GET", "POST"])
 def index():
     if request.method == "POST":
         instruction = request.form.get("instruction", "").strip()
         if not instruction:
-            return "入力が必要です", 400
+            return {"error": "入力が必要です"}, 400
 
-        # 同期キューを使用
-        q = queue.Queue()
+        session_id = request.form.get("session_id") or None
+        session = runner.sessions.checkout(session_id)
+        if session is None:
+            return {
+                "error": "この会話は実行中です。完了してから次の指示を送ってください。"
+            }, 409
 
-        def stream_callback(message):
-            q.put(message)
+        events = runs.start()
 
-        # 非同期処理を別スレッドで実行
-        def run_async():
-            asyncio.run(run_sampling_loop(instruction, stream_callback=stream_callback))
-            q.put(None)
+        def on_queue_position(position: int):
+            events.emit("queue", position=position)
 
-        thread = threading.Thread(target=run_async)
-        thread.start()
+        if session_id and session.id != session_id:
+            events.emit(
+                "notice", text="会話の有効期限が切れたため、新しい会話を開始しました。"
+            )
 
-        def generate():
-            while True:
-                msg = q.get()
-                if msg is None:
-                    break
-                yield str(msg) + "\n"
+        # 共有のイベントループで実行
+        future = runner.submit(
+            session,
+            lambda tool_collection: run_sampling_loop(
+                instruction,
+                emit=events.emit,
+                tool_collection=tool_collection,
+                messages=session.messages,
+                trace_path=(
+                    os.path.join(TRACE_DIR, f"{session.id}_{events.id}.json")
+                    if TRACE_DIR
+                    else None
+                ),
+            ),
+            on_queue_position,
+        )
+        if future is None:
+            runner.sessions.checkin(session)
+            events.close("rejected")
+            return {
+                "error": "混雑しています。しばらくしてから再度お試しください。"
+            }, 429
 
-        return Response(stream_with_context(generate()), mimetype="text/html")
+        def on_done(future: concurrent.futures.Future):
+            runner.sessions.checkin(session)
+            if future.cancelled():
+                events.close("cancelled")
+            elif future.exception():
+                app.logger.error("sampling loop failed", exc_info=future.exception())
+                events.close("failed", error=str(future.exception()))
+            else:
+                events.close("completed")
+
+        future.add_done_callback(on_done)
+        return {"session_id": session.id, "run_id": events.id}, 202
     else:
         return render_template("index.html")
 
 
-async def run_sampling_loop(instruction: str, stream_callback=None):
+@app.route("/metrics")
+def metrics_endpoint():
+    """Latency, token and image size metrics in the Prometheus text format."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/runs/<run_id>/events")
+def run_events(run_id: str):
+    """Stream the events of a run as Server-Sent Events, resuming after `Last-Event-ID`."""
+    events = runs.get(run_id)
+    if events is None:
+        return {"error": "not found"}, 404
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get(
+        "last_event_id", "0"
+    )
+    try:
+        position = int(last_event_id)
+    except ValueError:
+        return {"error": "invalid Last-Event-ID"}, 400
+
+    def generate():
+        nonlocal position
+        while True:
+            new_events, done = events.wait(position, timeout=SSE_KEEPALIVE_INTERVAL)
+            if not new_events and not done:
+                yield ": keep-alive\n\n"
+            for event in new_events:
+                yield event
+            position += len(new_events)
+            if done and not new_events:
+                return
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def run_sampling_loop(
+    instruction: str,
+    emit: Callable[..., None] = lambda event_type, **data: None,
+    tool_collection: ToolCollection | None = None,
+    messages: list[BetaMessageParam] | None = None,
+    trace_path: str | None = None,
+):
     api_key = os.getenv("ANTHROPIC_API_KEY", "YOUR_API_KEY_HERE")
     if api_key == "YOUR_API_KEY_HERE":
         message = "環境変数 ANTHROPIC_API_KEY に API キーをセットしてください。"
-        if stream_callback:
-            stream_callback(message)
+        emit("notice", text=message)
         return message
 
     provider = APIProvider.ANTHROPIC
 
-    messages: list[BetaMessageParam] = [
+    # follow-up instructions continue the session's conversation
+    if messages is None:
+        messages = []
+    n_messages = len(messages)
+    messages.append(
         {
             "role": "user",
             "content": instruction,
         }
-    ]
+    )
 
     output_collector = []
 
-    def output_callback(content_block):
-        if isinstance(content_block, dict) and content_block.get("type") == "text":
-            action_text = content_block.get("text")
-            output_collector.append(action_text)
-            if stream_callback:
-                stream_callback(action_text)
+    def output_callback(content_block: BetaContentBlock | BetaTextDelta):
+        if content_block.type == "text_delta":
+            output_collector.append(content_block.text)
+            emit("text_delta", text=content_block.text)
+        elif content_block.type == "text":
+            # the full text has already been streamed as deltas
+            emit("text", text=content_block.text)
+        elif content_block.type == "tool_use":
+            output_collector.append(content_block.input)
+            emit(
+                "tool_use",
+                id=content_block.id,
+                name=content_block.name,
+                input=content_block.input,
+            )
 
     def tool_output_callback(result: ToolResult, tool_use_id: str):
-        if result.base64_image:
-            os.makedirs("screenshots", exist_ok=True)
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            filename = f"screenshots/screenshot_{timestamp}_{tool_use_id}.png"
-            with open(filename, "wb") as f:
-                f.write(base64.b64decode(result.base64_image))
-            if stream_callback:
-                stream_callback(filename)
-
-    def api_response_callback(response: APIResponse[BetaMessage]):
-        try:
-            data = json.loads(response.text)
-            content_array = data.get("content", [])
-            for block in content_array:
-                if isinstance(block, dict):
-                    block_type = block.get("type")
-                    if block_type == "text":
-                        if block.get("text"):
-                            message = block["text"]
-                            output_collector.append(message)
-                            if stream_callback:
-                                stream_callback(message)
-                    elif block_type == "tool_use":
-                        if block.get("input"):
-                            message = block["input"]
-                            output_collector.append(message)
-                            if stream_callback:
-                                stream_callback(message)
-        except Exception as e:
-            message = "Error parsing API response: " + str(e)
-            output_collector.append(message)
-            if stream_callback:
-                stream_callback(message)
-
-    await sampling_loop(
-        model="claude-3-5-sonnet-20241022",
-        provider=provider,
-        system_prompt_suffix="",
-        messages=messages,
-        output_callback=output_callback,
-        tool_output_callback=tool_output_callback,
-        api_response_callback=api_response_callback,
-        api_key=api_key,
-        only_n_most_recent_images=10,
-        max_tokens=4096,
-    )
+        emit(
+            "tool_result",
+            tool_use_id=tool_use_id,
+            output=result.output,
+            error=result.error,
+            system=result.system,
+        )
+        if result.image:
+            # identical frames are stored once; writing happens off the event loop
+            name = image_store.put(result.image, result.image_media_type or "image/png")
+            emit("image", tool_use_id=tool_use_id, url=f"/screenshots/{name}")
+
+    def api_response_callback(response: SamplingResponse):
+        # content is already streamed through output_callback
+        usage = response.usage
+        emit(
+            "turn",
+            stop_reason=response.message.stop_reason,
+            usage=usage.model_dump(mode="json"),
+            elapsed=response.elapsed,
+            time_to_first_token=response.time_to_first_token,
+        )
+        app.logger.info(
+            "tokens: input=%d output=%d cache_read=%d cache_write=%d elapsed=%.2fs",
+            usage.input_tokens,
+            usage.output_tokens,
+            usage.cache_read_input_tokens or 0,
+            usage.cache_creation_input_tokens or 0,
+            response.elapsed,
+        )
+
+    try:
+        await sampling_loop(
+            model="claude-3-5-sonnet-20241022",
+            provider=provider,
+            system_prompt_suffix="",
+            messages=messages,
+            output_callback=output_callback,
+            tool_output_callback=tool_output_callback,
+            api_response_callback=api_response_callback,
+            api_key=api_key,
+            only_n_most_recent_images=10,
+            max_tokens=4096,
+            stream=True,
+            tool_collection=tool_collection,
+            trace_path=trace_path,
+        )
+    except BaseException:
+        # an unfinished turn (e.g. a tool call without its result) would make the
+        # next request of the conversation fail, so drop this instruction's turns
+        del messages[n_messages:]
+        raise
 
     return "\n".join(str(x) for x in output_collector)
 
@@ -0,0 +1,80 @@
+"""
+Memory used by the edit tool's undo history over many edits to large files.
+
+Applies small random edits to synthetic source files, recording each undo state in
+an EditHistory, and reports the history's size and the memory allocated while
+doing so, next to what keeping a full copy per edit would take, plus the time per
+edit and per undo.
+
+    python benchmarks/edit_history.py [--files N] [--edits N] [--lines N]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from computer_use_demo.tools.history import EditHistory  # noqa: E402
+
+
+def source_file(rng: random.Random, lines: int) -> str:
+    words = ["self", "value", "return", "if", "for", "in", "None", "result", "data"]
+    return "".join(
+        f"    {' '.join(rng.choices(words, k=rng.randrange(3, 12)))}  # line {i}\n"
+        for i in range(lines)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--files", type=int, default=4)
+    parser.add_argument("--edits", type=int, default=50, help="edits per file")
+    parser.add_argument("--lines", type=int, default=40_000, help="lines per file")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    texts = {
+        Path(f"/bench/file{i}.py"): source_file(rng, args.lines)
+        for i in range(args.files)
+    }
+    file_size = sum(len(text.encode()) for text in texts.values()) / args.files
+    print(f"{args.files} files of {file_size / 1e6:.1f} MB, {args.edits} edits each")
+
+    history = EditHistory()
+    full_copies = 0
+    edit_time = 0.0
+    tracemalloc.start()
+    for _ in range(args.edits):
+        for path, text in texts.items():
+            position = rng.randrange(len(text))
+            text = text[:position] + "edited = True\n" + text[position + 5 :]
+            texts[path] = text
+            started = time.perf_counter()
+            history.push(path, text)
+            edit_time += time.perf_counter() - started
+            full_copies += len(text.encode())
+    traced, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    n_edits = args.edits * args.files
+    print(f"history size        {history.size / 1e6:8.2f} MB")
+    print(
+        f"traced memory       {traced / 1e6:8.2f} MB (peak {peak / 1e6:.2f} MB, "
+        "including the current texts)"
+    )
+    print(f"full copies         {full_copies / 1e6:8.2f} MB")
+    print(f"time per edit       {edit_time / n_edits * 1000:8.1f} ms")
+
+    path = next(iter(texts))
+    started = time.perf_counter()
+    assert history.pop(path) == texts[path]
+    print(f"time per undo       {(time.perf_counter() - started) * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+Per-turn cost of evicting old screenshots from the message history.
+
+Builds a synthetic session with a screenshot every other turn and times the
+eviction step of each turn, as the sampling loop runs it with
+only_n_most_recent_images=10. The cost should stay flat however long the session.
+
+    python benchmarks/image_eviction.py [turns ...]
+"""
+
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from computer_use_demo.loop import _ImageIndex  # noqa: E402
+
+IMAGES_TO_KEEP = 10
+MIN_REMOVAL_THRESHOLD = 10
+
+
+def tool_result(i: int) -> dict:
+    content = [{"type": "text", "text": "done"}]
+    if i % 2 == 0:
+        content.append(
+            {
+                "type": "image",
+                "source": {"type": "base64", "media_type": "image/png", "data": "x"},
+            }
+        )
+    return {
+        "type": "tool_result",
+        "tool_use_id": f"toolu_{i}",
+        "content": content,
+        "is_error": False,
+    }
+
+
+def run(turns: int) -> list[float]:
+    """Seconds spent evicting on each turn of a session of `turns` turns."""
+    messages: list[dict] = [{"role": "user", "content": "go"}]
+    index = _ImageIndex(messages)  # type: ignore[arg-type]
+    timings = []
+    for i in range(turns):
+        result = tool_result(i)
+        messages.append({"role": "assistant", "content": []})
+        messages.append({"role": "user", "content": [result]})
+        index.add(result)  # type: ignore[arg-type]
+        started = time.perf_counter()
+        index.evict(IMAGES_TO_KEEP, min_removal_threshold=MIN_REMOVAL_THRESHOLD)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def main():
+    session_lengths = [int(arg) for arg in sys.argv[1:]] or [100, 500, 1000, 2000]
+    print(f"{'turns':>6} {'mean/turn':>10} {'last 100 turns':>15}")
+    for turns in session_lengths:
+        timings = run(turns)
+        print(
+            f"{turns:>6} {statistics.mean(timings) * 1e6:>8.1f}us "
+            f"{statistics.mean(timings[-100:]) * 1e6:>13.1f}us"
+        )
+
+
+if __name__ == "__main__":
+    main()
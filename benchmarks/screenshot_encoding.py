@@ -0,0 +1,78 @@
+"""
+Size and encoding time of a screenshot in each of ComputerTool's formats.
+
+By default a synthetic UI-like Retina frame (2560x1600: panels and lots of text) is
+used, so results are comparable between machines; with --screen the current screen
+is captured instead. Frames are scaled to the width sent to the model first, as the
+tool does, and the time includes that resize. Reports the median of several runs.
+
+    python benchmarks/screenshot_encoding.py [--screen] [--runs N]
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from computer_use_demo.tools.computer import (  # noqa: E402
+    ComputerTool,
+    ScreenshotFormat,
+)
+
+MAX_WIDTH = 1280
+
+
+def synthetic_frame(width: int = 2560, height: int = 1600) -> Image.Image:
+    rng = random.Random(0)
+    frame = Image.new("RGB", (width, height), (245, 245, 247))
+    draw = ImageDraw.Draw(frame)
+    for _ in range(300):
+        x, y = rng.randrange(width - 160), rng.randrange(height - 50)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.rectangle(
+            [x, y, x + rng.randrange(40, 400), y + rng.randrange(10, 60)], fill=color
+        )
+    for _ in range(2500):
+        position = (rng.randrange(width - 60), rng.randrange(height - 10))
+        draw.text(position, "Lorem ipsum dolor sit amet", fill=(20, 20, 20))
+    return frame
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--screen", action="store_true", help="capture the screen")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.screen:
+        import pyautogui
+
+        frame = pyautogui.screenshot()
+    else:
+        frame = synthetic_frame()
+    scale = min(MAX_WIDTH / frame.width, 1.0)
+    size = (int(frame.width * scale), int(frame.height * scale))
+    print(f"{frame.width}x{frame.height} frame, sent at {size[0]}x{size[1]}")
+
+    print(f"{'format':<9} {'size':>10} {'time':>9}")
+    for screenshot_format in ScreenshotFormat:
+        tool = ComputerTool(screenshot_format=screenshot_format)
+        timings = []
+        for _ in range(args.runs):
+            started = time.perf_counter()
+            image = tool._encode_screenshot(frame.resize(size))
+            timings.append(time.perf_counter() - started)
+        print(
+            f"{screenshot_format:<9} {len(image) / 1024:>6.0f} KiB "
+            f"{statistics.median(timings) * 1000:>6.0f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
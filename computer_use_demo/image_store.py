@@ -0,0 +1,105 @@
+"""Content-addressed image store that writes to disk off the caller's thread."""
+
+import hashlib
+import mimetypes
+import os
+import queue
+import re
+import tempfile
+import threading
+
+_NAME_PATTERN = re.compile(r"([0-9a-f]{64})\.\w+")
+
+# temp files are created owner-only; stored images get the mode `open` would give
+# them. The umask can only be read by setting it, so that is done once, at import.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+_FILE_MODE = 0o666 & ~_UMASK
+
+
+class ImageStore:
+    """
+    Images stored once per content, as `<sha256><extension>` files in `directory`.
+
+    `put` only hashes the image and queues it; a background thread writes it to disk
+    (through a temp file, so a half-written image is never served). Until then the
+    image is served from memory by `get`.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+        # images queued but not yet written, by name
+        self._pending: dict[str, bytes | memoryview] = {}
+        # names known to be on disk
+        self._stored: set[str] = set()
+        self._queue: queue.Queue[str] = queue.Queue()
+        threading.Thread(
+            target=self._write_images, name="image-store", daemon=True
+        ).start()
+
+    def put(self, data: bytes | memoryview, media_type: str = "image/png") -> str:
+        """Store an image and return its name; identical images get the same name."""
+        name = hashlib.sha256(data).hexdigest() + (
+            mimetypes.guess_extension(media_type) or ""
+        )
+        with self._lock:
+            if name in self._stored or name in self._pending:
+                return name
+            self._pending[name] = data
+        self._queue.put(name)
+        return name
+
+    def get(self, name: str) -> bytes | memoryview | str | None:
+        """
+        Return an image that is still waiting to be written, the path of one on
+        disk, or None if there is no such image.
+        """
+        if not _NAME_PATTERN.fullmatch(name):
+            return None
+        with self._lock:
+            data = self._pending.get(name)
+        if data is not None:
+            return data
+        path = os.path.join(self.directory, name)
+        return path if os.path.isfile(path) else None
+
+    @staticmethod
+    def etag(name: str) -> str:
+        """Strong ETag of an image: the hash its name is made of."""
+        return name.split(".", 1)[0]
+
+    def flush(self):
+        """Wait until all queued images have been written."""
+        self._queue.join()
+
+    def _write_images(self):
+        while True:
+            name = self._queue.get()
+            try:
+                self._write(name)
+            finally:
+                self._queue.task_done()
+
+    def _write(self, name: str):
+        with self._lock:
+            data = self._pending[name]
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            except OSError:
+                # keep serving it from memory
+                return
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    os.fchmod(f.fileno(), _FILE_MODE)
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError:
+                os.unlink(tmp_path)
+                return
+        with self._lock:
+            del self._pending[name]
+            self._stored.add(name)
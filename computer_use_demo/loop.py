@@ -2,15 +2,27 @@
 Agentic sampling loop that calls the Anthropic API and local implenmentation of anthropic-defined computer use tools.
 """
 
+import asyncio
+import hashlib
 import platform
+import threading
+import time
+import weakref
+from collections import deque
 from collections.abc import Callable
+from dataclasses import dataclass
 from datetime import datetime
 from enum import StrEnum
+from functools import cached_property
 from typing import Any, cast
 
-from anthropic import Anthropic, AnthropicBedrock, AnthropicVertex, APIResponse
-from anthropic.types import (
-    ToolResultBlockParam,
+import httpx
+from anthropic import (
+    AsyncAnthropic,
+    AsyncAnthropicBedrock,
+    AsyncAnthropicVertex,
+    APIResponse,
+    DefaultAsyncHttpxClient,
 )
 from anthropic.types.beta import (
     BetaContentBlock,
@@ -19,12 +31,52 @@ from anthropic.types.beta import (
     BetaMessage,
     BetaMessageParam,
     BetaTextBlockParam,
+    BetaTextDelta,
     BetaToolResultBlockParam,
+    BetaToolUnionParam,
+    BetaUsage,
 )
 
+from . import metrics, tracing
 from .tools import BashTool, ComputerTool, EditTool, ToolCollection, ToolResult
 
 BETA_FLAG = "computer-use-2024-10-22"
+PROMPT_CACHING_BETA_FLAG = "prompt-caching-2024-07-31"
+
+# At most 4 cache breakpoints are allowed per request: one each for the tool
+# definitions and the system prompt, the rest roll with the latest user turns.
+ROLLING_CACHE_BREAKPOINTS = 2
+
+
+@dataclass(frozen=True)
+class SamplingResponse:
+    """
+    A model response, parsed once and handed to `api_response_callback`.
+
+    `elapsed` is the time from sending the request to having the whole response,
+    and `time_to_first_token` the time until its first content arrived (streamed
+    requests only), both in seconds. `raw_response` is the HTTP response of a
+    request that was not streamed.
+    """
+
+    message: BetaMessage
+    elapsed: float
+    time_to_first_token: float | None = None
+    raw_response: APIResponse[BetaMessage] | None = None
+
+    @property
+    def usage(self) -> BetaUsage:
+        return self.message.usage
+
+    @cached_property
+    def raw_text(self) -> str:
+        """
+        The response body as received, or for a streamed response the final message
+        as JSON; only produced when asked for.
+        """
+        if self.raw_response is not None:
+            return self.raw_response.text
+        return self.message.to_json(indent=None)
 
 
 class APIProvider(StrEnum):
@@ -39,6 +91,21 @@ PROVIDER_TO_DEFAULT_MODEL_NAME: dict[APIProvider, str] = {
     APIProvider.VERTEX: "claude-3-5-sonnet-v2@20241022",
 }
 
+# Connection pool settings for the shared API clients. Keep-alive connections are
+# what let consecutive turns skip the TLS handshake.
+MAX_CONNECTIONS = 20
+MAX_KEEPALIVE_CONNECTIONS = 10
+KEEPALIVE_EXPIRY = 120.0  # seconds
+
+AsyncClient = AsyncAnthropic | AsyncAnthropicBedrock | AsyncAnthropicVertex
+
+# async clients are bound to the event loop they were first used on, so the
+# registry is kept per loop and dropped together with it
+_clients: weakref.WeakKeyDictionary[
+    asyncio.AbstractEventLoop, dict[tuple, AsyncClient]
+] = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
 
 # This system prompt is optimized for the Docker environment in this repository and
 # specific tool combinations enabled.
@@ -48,6 +115,7 @@ PROVIDER_TO_DEFAULT_MODEL_NAME: dict[APIProvider, str] = {
 SYSTEM_PROMPT = f"""<SYSTEM_CAPABILITY>
 * You are utilizing a MacOS computer using {platform.machine()} architecture with internet access.
 * You can use the bash tool to execute commands in the terminal.
+* Besides `command` and `restart`, the bash tool accepts optional `session` (name of a separate shell; sessions keep their own state and run concurrently), `background` (set to true to start a long-running command such as a build or server as a job and get its job id back immediately) and `job` (a job id to poll for its status and output so far) parameters.
 * To open applications, you can use the `open` command in the bash tool. For example, `open -a Safari` to open the Safari browser.
 * When using your bash tool with commands that are expected to output very large quantities of text, redirect the output into a temporary file and use `str_replace_editor` or `grep -n -B <lines before> -A <lines after> <query> <filename>` to inspect the output.
 * When viewing a page, it can be helpful to zoom out so that you can see everything on the page. Alternatively, ensure you scroll down to see everything before deciding something isn't available.
@@ -61,132 +129,362 @@ SYSTEM_PROMPT = f"""<SYSTEM_CAPABILITY>
 </IMPORTANT>"""
 
 
+def get_client(
+    provider: APIProvider,
+    api_key: str | None = None,
+    *,
+    max_connections: int = MAX_CONNECTIONS,
+    max_keepalive_connections: int = MAX_KEEPALIVE_CONNECTIONS,
+) -> AsyncClient:
+    """
+    Return a shared async API client for the given provider and credentials on the
+    running event loop, creating it on first use. One pooled client is reused
+    across turns and across concurrent sessions running on the same loop.
+    """
+    # never keep the raw key around as a dict key
+    credentials = hashlib.sha256((api_key or "").encode()).hexdigest()
+    key = (provider, credentials, max_connections, max_keepalive_connections)
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        loop_clients = _clients.setdefault(loop, {})
+        client = loop_clients.get(key)
+        if client is None:
+            http_client = DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_keepalive_connections,
+                    keepalive_expiry=KEEPALIVE_EXPIRY,
+                )
+            )
+            if provider == APIProvider.ANTHROPIC:
+                client = AsyncAnthropic(api_key=api_key, http_client=http_client)
+            elif provider == APIProvider.VERTEX:
+                client = AsyncAnthropicVertex(http_client=http_client)
+            elif provider == APIProvider.BEDROCK:
+                client = AsyncAnthropicBedrock(http_client=http_client)
+            else:
+                raise ValueError(f"Unknown API provider: {provider}")
+            loop_clients[key] = client
+    return client
+
+
 async def sampling_loop(
     *,
     model: str,
     provider: APIProvider,
     system_prompt_suffix: str,
     messages: list[BetaMessageParam],
-    output_callback: Callable[[BetaContentBlock], None],
+    output_callback: Callable[[BetaContentBlock | BetaTextDelta], None],
     tool_output_callback: Callable[[ToolResult, str], None],
-    api_response_callback: Callable[[APIResponse[BetaMessage]], None],
+    api_response_callback: Callable[[SamplingResponse], None],
     api_key: str,
     only_n_most_recent_images: int | None = None,
     max_tokens: int = 4096,
+    stream: bool = False,
+    tool_collection: ToolCollection | None = None,
+    trace_path: str | None = None,
 ):
     """
     Agentic sampling loop for the assistant/tool interaction of computer use.
-    """
-    tool_collection = ToolCollection(
-        ComputerTool(),
-        BashTool(),
-        EditTool(),
-    )
-    system = (
-        f"{SYSTEM_PROMPT}{' ' + system_prompt_suffix if system_prompt_suffix else ''}"
-    )
 
-    while True:
-        if only_n_most_recent_images:
-            _maybe_filter_to_n_most_recent_images(messages, only_n_most_recent_images)
-
-        if provider == APIProvider.ANTHROPIC:
-            client = Anthropic(api_key=api_key)
-        elif provider == APIProvider.VERTEX:
-            client = AnthropicVertex()
-        elif provider == APIProvider.BEDROCK:
-            client = AnthropicBedrock()
-
-        # Call the API
-        # we use raw_response to provide debug information to streamlit. Your
-        # implementation may be able call the SDK directly with:
-        # `response = client.messages.create(...)` instead.
-        raw_response = client.beta.messages.with_raw_response.create(
-            max_tokens=max_tokens,
-            messages=messages,
-            model=model,
-            system=system,
-            tools=tool_collection.to_params(),
-            betas=["computer-use-2024-10-22"],
-        )
+    Every response is parsed once and `api_response_callback` receives it as a
+    `SamplingResponse`, with its usage and timings.
 
-        api_response_callback(cast(APIResponse[BetaMessage], raw_response))
+    With `stream=True` the response is streamed: text is passed to `output_callback`
+    as `BetaTextDelta` chunks while it arrives (followed by the completed blocks), and
+    `api_response_callback` receives the final accumulated message. Tool calls start
+    executing as soon as their `tool_use` block has been received, while the rest of
+    the response is still streaming.
 
-        response = raw_response.parse()
+    A `tool_collection` can be passed in to reuse tools across calls; by default a
+    new set of tools is created.
 
-        messages.append(
-            {
-                "role": "assistant",
-                "content": cast(list[BetaContentBlockParam], response.content),
-            }
+    With a `trace_path`, a timeline of the loop (API calls, tool calls, bash commands,
+    screenshot stages and callbacks) is written there in the Chrome Trace Event
+    Format when the loop ends; see `tracing`.
+    """
+    if tool_collection is None:
+        tool_collection = ToolCollection(
+            ComputerTool(),
+            BashTool(),
+            EditTool(),
+        )
+    system = BetaTextBlockParam(
+        type="text",
+        text=f"{SYSTEM_PROMPT}{' ' + system_prompt_suffix if system_prompt_suffix else ''}",
+    )
+    tools = tool_collection.to_params()
+    betas = [BETA_FLAG]
+    image_truncation_threshold = 10
+
+    enable_prompt_caching = provider == APIProvider.ANTHROPIC
+    if enable_prompt_caching:
+        betas.append(PROMPT_CACHING_BETA_FLAG)
+        system["cache_control"] = {"type": "ephemeral"}
+        tools[-1] = cast(
+            BetaToolUnionParam, {**tools[-1], "cache_control": {"type": "ephemeral"}}
         )
+        # evicting images rewrites the history from the oldest removed image on,
+        # so only do it once every `only_n_most_recent_images` images to keep the
+        # cached prefix valid for as many turns as possible
+        if only_n_most_recent_images:
+            image_truncation_threshold = only_n_most_recent_images
 
-        tool_result_content: list[BetaToolResultBlockParam] = []
-        for content_block in cast(list[BetaContentBlock], response.content):
-            output_callback(content_block)
-            if content_block.type == "tool_use":
-                result = await tool_collection.run(
-                    name=content_block.name,
-                    tool_input=cast(dict[str, Any], content_block.input),
-                )
-                tool_result_content.append(
-                    _make_api_tool_result(result, content_block.id)
+    image_index = _ImageIndex(messages)
+
+    with tracing.record(trace_path):
+        if tracing.enabled():
+            output_callback = tracing.traced(
+                output_callback, "output_callback", "callback"
+            )
+            tool_output_callback = tracing.traced(
+                tool_output_callback, "tool_output_callback", "callback"
+            )
+            api_response_callback = tracing.traced(
+                api_response_callback, "api_response_callback", "callback"
+            )
+        while True:
+            with tracing.span(
+                "prepare request", "loop", messages=len(messages)
+            ) as span_args:
+                if only_n_most_recent_images:
+                    image_index.evict(
+                        only_n_most_recent_images,
+                        min_removal_threshold=image_truncation_threshold,
+                    )
+                if enable_prompt_caching:
+                    _inject_prompt_caching(messages)
+                span_args["images"] = len(image_index)
+
+            client = get_client(provider, api_key)
+
+            # tool calls are started as soon as their block is complete; the collection
+            # runs independent calls concurrently and conflicting ones in issue order
+            tool_runs: list[tuple[str, asyncio.Task[ToolResult]]] = []
+
+            def on_content_block(content_block: BetaContentBlock):
+                output_callback(content_block)
+                if content_block.type == "tool_use":
+                    task = tool_collection.submit(
+                        name=content_block.name,
+                        tool_input=cast(dict[str, Any], content_block.input),
+                    )
+                    tool_runs.append((content_block.id, task))
+
+            # once a tool call has been submitted, the loop owns it: if anything fails
+            # before its result is collected, it must not keep driving the screen
+            try:
+                with tracing.span(
+                    "api request",
+                    "api",
+                    model=model,
+                    stream=stream,
+                    messages=len(messages),
+                ):
+                    started = time.perf_counter()
+                    if stream:
+                        response, time_to_first_token = await _stream_response(
+                            client,
+                            output_callback,
+                            on_content_block,
+                            max_tokens=max_tokens,
+                            messages=messages,
+                            model=model,
+                            system=[system],
+                            tools=tools,
+                            betas=betas,
+                        )
+                        sampling_response = SamplingResponse(
+                            message=response,
+                            elapsed=time.perf_counter() - started,
+                            time_to_first_token=time_to_first_token,
+                        )
+                    else:
+                        # Call the API
+                        # we use raw_response to provide debug information to
+                        # streamlit. Your implementation may be able call the SDK
+                        # directly with:
+                        # `response = await client.messages.create(...)` instead.
+                        raw_response = (
+                            await client.beta.messages.with_raw_response.create(
+                                max_tokens=max_tokens,
+                                messages=messages,
+                                model=model,
+                                system=[system],
+                                tools=tools,
+                                betas=betas,
+                            )
+                        )
+                        _annotate_http_sizes(raw_response.http_response)
+
+                        response = raw_response.parse()
+                        sampling_response = SamplingResponse(
+                            message=response,
+                            elapsed=time.perf_counter() - started,
+                            raw_response=cast(APIResponse[BetaMessage], raw_response),
+                        )
+                    _observe_response(sampling_response, stream)
+                api_response_callback(sampling_response)
+
+                if not stream:
+                    for content_block in cast(list[BetaContentBlock], response.content):
+                        on_content_block(content_block)
+
+                messages.append(
+                    {
+                        "role": "assistant",
+                        "content": cast(list[BetaContentBlockParam], response.content),
+                    }
                 )
-                tool_output_callback(result, content_block.id)
 
-        if not tool_result_content:
-            return messages
+                tool_result_content: list[BetaToolResultBlockParam] = []
+                for tool_use_id, task in tool_runs:
+                    result = await task
+                    with tracing.span(
+                        "tool result", "loop", tool_use_id=tool_use_id
+                    ) as span_args:
+                        api_tool_result = _make_api_tool_result(result, tool_use_id)
+                        if result.image:
+                            metrics.IMAGE_BYTES.observe(len(result.image))
+                            span_args["image_bytes"] = len(result.image)
+                            span_args["base64_bytes"] = len(result.base64_image)
+                        image_index.add(api_tool_result)
+                        tool_result_content.append(api_tool_result)
+                    tool_output_callback(result, tool_use_id)
+            except BaseException:
+                for _, task in tool_runs:
+                    task.cancel()
+                raise
+
+            if not tool_result_content:
+                return messages
+
+            messages.append({"content": tool_result_content, "role": "user"})
+
+
+def _observe_response(response: SamplingResponse, stream: bool):
+    metrics.API_LATENCY.observe(response.elapsed, stream=str(stream).lower())
+    if response.time_to_first_token is not None:
+        metrics.TIME_TO_FIRST_TOKEN.observe(response.time_to_first_token)
+    usage = response.usage
+    metrics.TOKENS.inc(usage.input_tokens, kind="input")
+    metrics.TOKENS.inc(usage.output_tokens, kind="output")
+    metrics.TOKENS.inc(usage.cache_read_input_tokens or 0, kind="cache_read")
+    metrics.TOKENS.inc(usage.cache_creation_input_tokens or 0, kind="cache_write")
+    tracing.annotate(
+        stop_reason=response.message.stop_reason,
+        input_tokens=usage.input_tokens,
+        output_tokens=usage.output_tokens,
+        cache_read_input_tokens=usage.cache_read_input_tokens or 0,
+        cache_creation_input_tokens=usage.cache_creation_input_tokens or 0,
+        time_to_first_token=response.time_to_first_token,
+    )
+
 
-        messages.append({"content": tool_result_content, "role": "user"})
+def _annotate_http_sizes(http_response: httpx.Response):
+    """Add the size of the request and response bodies to the current span."""
+    if tracing.enabled():
+        tracing.annotate(
+            request_bytes=len(http_response.request.content),
+            response_bytes=http_response.num_bytes_downloaded,
+        )
 
 
-def _maybe_filter_to_n_most_recent_images(
-    messages: list[BetaMessageParam],
-    images_to_keep: int,
-    min_removal_threshold: int = 10,
-):
+async def _stream_response(
+    client: AsyncClient,
+    output_callback: Callable[[BetaContentBlock | BetaTextDelta], None],
+    content_block_callback: Callable[[BetaContentBlock], None],
+    **request: Any,
+) -> tuple[BetaMessage, float | None]:
     """
-    With the assumption that images are screenshots that are of diminishing value as
-    the conversation progresses, remove all but the final `images_to_keep` tool_result
-    images in place, with a chunk of min_removal_threshold to reduce the amount we
-    break the implicit prompt cache.
+    Stream a response, forwarding text deltas as they arrive and each content block
+    as soon as it is complete, and return the final message along with the seconds
+    it took for its first content to arrive.
     """
-    if images_to_keep is None:
-        return messages
-
-    tool_result_blocks = cast(
-        list[ToolResultBlockParam],
-        [
-            item
-            for message in messages
-            for item in (
-                message["content"] if isinstance(message["content"], list) else []
-            )
-            if isinstance(item, dict) and item.get("type") == "tool_result"
-        ],
-    )
-
-    total_images = sum(
-        1
-        for tool_result in tool_result_blocks
-        for content in tool_result.get("content", [])
-        if isinstance(content, dict) and content.get("type") == "image"
-    )
+    started = time.perf_counter()
+    time_to_first_token = None
+    async with client.beta.messages.stream(**request) as response_stream:
+        async for event in response_stream:
+            if time_to_first_token is None and event.type == "content_block_start":
+                time_to_first_token = time.perf_counter() - started
+            if event.type == "text":
+                output_callback(BetaTextDelta(type="text_delta", text=event.text))
+            elif event.type == "content_block_stop":
+                content_block_callback(event.content_block)
+        message = await response_stream.get_final_message()
+        _annotate_http_sizes(response_stream.response)
+        return message, time_to_first_token
+
+
+class _ImageIndex:
+    """
+    Locations of the tool_result images in the message history, oldest first.
 
-    images_to_remove = total_images - images_to_keep
-    # for better cache behavior, we want to remove in chunks
-    images_to_remove -= images_to_remove % min_removal_threshold
+    The index is built once from the initial messages and then extended with every
+    tool result the loop appends, so evicting old images only touches the blocks
+    being dropped instead of rescanning the whole history each turn.
+    """
 
-    for tool_result in tool_result_blocks:
-        if isinstance(tool_result.get("content"), list):
-            new_content = []
-            for content in tool_result.get("content", []):
-                if isinstance(content, dict) and content.get("type") == "image":
-                    if images_to_remove > 0:
-                        images_to_remove -= 1
-                        continue
-                new_content.append(content)
-            tool_result["content"] = new_content
+    def __init__(self, messages: list[BetaMessageParam]):
+        self._images: deque[tuple[BetaToolResultBlockParam, BetaImageBlockParam]] = (
+            deque()
+        )
+        for message in messages:
+            if isinstance(message["content"], list):
+                for item in message["content"]:
+                    if isinstance(item, dict) and item.get("type") == "tool_result":
+                        self.add(cast(BetaToolResultBlockParam, item))
+
+    def __len__(self):
+        return len(self._images)
+
+    def add(self, tool_result: BetaToolResultBlockParam):
+        """Record the images of a tool_result block appended to the history."""
+        content = tool_result.get("content")
+        if isinstance(content, list):
+            for item in content:
+                if isinstance(item, dict) and item.get("type") == "image":
+                    self._images.append((tool_result, cast(BetaImageBlockParam, item)))
+
+    def evict(self, images_to_keep: int, min_removal_threshold: int = 10):
+        """
+        With the assumption that images are screenshots that are of diminishing value
+        as the conversation progresses, remove all but the final `images_to_keep`
+        tool_result images in place, with a chunk of min_removal_threshold to reduce
+        the amount we break the implicit prompt cache.
+        """
+        images_to_remove = len(self._images) - images_to_keep
+        # for better cache behavior, we want to remove in chunks
+        images_to_remove -= images_to_remove % min_removal_threshold
+
+        for _ in range(max(images_to_remove, 0)):
+            tool_result, image = self._images.popleft()
+            content = cast(list, tool_result["content"])
+            # compare by identity: equal screenshots are distinct blocks
+            for i, item in enumerate(content):
+                if item is image:
+                    del content[i]
+                    break
+
+
+def _inject_prompt_caching(messages: list[BetaMessageParam]):
+    """
+    Set a cache breakpoint on the last content block of the most recent user turns
+    (normally tool results) and clear the ones from older turns, so the cached
+    prefix rolls forward with the conversation.
+    """
+    breakpoints_remaining = ROLLING_CACHE_BREAKPOINTS
+    for message in reversed(messages):
+        if message["role"] == "user" and isinstance(
+            content := message["content"], list
+        ):
+            if breakpoints_remaining:
+                breakpoints_remaining -= 1
+                content[-1]["cache_control"] = {"type": "ephemeral"}  # type: ignore
+            else:
+                content[-1].pop("cache_control", None)  # type: ignore
+                # older turns were cleared when they were last in this position
+                break
 
 
 def _make_api_tool_result(
@@ -206,13 +504,13 @@ def _make_api_tool_result(
                     "text": _maybe_prepend_system_tool_result(result, result.output),
                 }
             )
-        if result.base64_image:
+        if result.image:
             tool_result_content.append(
                 {
                     "type": "image",
                     "source": {
                         "type": "base64",
-                        "media_type": "image/png",
+                        "media_type": result.image_media_type or "image/png",
                         "data": result.base64_image,
                     },
                 }
@@ -0,0 +1,196 @@
+"""
+Minimal Prometheus-style metrics of the agent loop and its tools, kept in process.
+
+`render` produces the Prometheus text exposition format and `summary` a short
+human-readable report.
+"""
+
+import bisect
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = tuple(4**i * 1024 for i in range(2, 9))  # 16 KiB to 64 MiB
+
+_metrics: list["_Metric"] = []
+
+
+class _Metric:
+    type: str
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels: dict[str, object]) -> tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _samples(self) -> Iterator[tuple[str, tuple[tuple[str, str], ...], float]]:
+        raise NotImplementedError
+
+    def _labels(self, key: tuple[str, ...]) -> tuple[tuple[str, str], ...]:
+        return tuple(zip(self.labelnames, key))
+
+
+class Counter(_Metric):
+    """A value that only goes up, per combination of label values."""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, self._labels(key), value
+
+
+class Histogram(_Metric):
+    """Observations counted into buckets, per combination of label values."""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+        # per series: the count of each bucket (the last one is +Inf), and the sum
+        self._series: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._series.setdefault(
+                key, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent in the block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _snapshot(self):
+        with self._lock:
+            return [
+                (key, list(counts), total[0])
+                for key, (counts, total) in self._series.items()
+            ]
+
+    def _samples(self):
+        for key, counts, total in self._snapshot():
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", (*labels, ("le", str(bound))), cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, cumulative
+
+    def _quantile_bound(self, counts: list[int], q: float) -> str:
+        """Upper bound of the bucket the q-quantile falls in."""
+        rank = q * sum(counts)
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            if cumulative >= rank:
+                return _format_value(bound)
+        return "+Inf"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format."""
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, labels, value in metric._samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def summary() -> str:
+    """A human-readable summary of everything observed so far."""
+    lines = []
+    for metric in _metrics:
+        if isinstance(metric, Histogram):
+            for key, counts, total in metric._snapshot():
+                n = sum(counts)
+                lines.append(
+                    f"{metric.name}{_format_labels(metric._labels(key))}: n={n} "
+                    f"mean={total / n:.4g} p50<={metric._quantile_bound(counts, 0.5)} "
+                    f"p95<={metric._quantile_bound(counts, 0.95)}"
+                )
+        else:
+            for name, labels, value in metric._samples():
+                lines.append(f"{name}{_format_labels(labels)}: {_format_value(value)}")
+    return "\n".join(lines)
+
+
+API_LATENCY = Histogram(
+    "agent_api_request_seconds",
+    "Time from sending an API request to having the complete response.",
+    ("stream",),
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "agent_api_time_to_first_token_seconds",
+    "Time from sending a streamed API request to receiving its first content.",
+)
+TOKENS = Counter(
+    "agent_tokens_total",
+    "Tokens used by API requests, by kind (input, output, cache_read, cache_write).",
+    ("kind",),
+)
+TOOL_LATENCY = Histogram(
+    "agent_tool_seconds",
+    "Time spent running a tool call, by tool and action.",
+    ("tool", "action"),
+)
+SCREENSHOT_STAGE_LATENCY = Histogram(
+    "agent_screenshot_stage_seconds",
+    "Time spent in each stage of taking a screenshot (settle, capture, resize, "
+    "encode); settle is the wait for the screen to settle, captures included.",
+    ("stage",),
+)
+IMAGE_BYTES = Histogram(
+    "agent_image_bytes",
+    "Size of the images sent to the model.",
+    buckets=SIZE_BUCKETS,
+)
@@ -0,0 +1,85 @@
+"""
+Server-side conversation sessions, which keep their message history and stateful
+tools between requests.
+"""
+
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from anthropic.types.beta import BetaMessageParam
+
+from .tools import BashTool, ComputerTool, EditTool, ToolCollection
+
+
+class Session:
+    """A conversation: its message history and the tools that keep state across turns."""
+
+    def __init__(self, session_id: str):
+        self.id = session_id
+        self.messages: list[BetaMessageParam] = []
+        self.bash = BashTool()
+        self.edit = EditTool()
+        self.running = False
+        self.last_used = time.monotonic()
+
+    def tool_collection(self, computer: ComputerTool) -> ToolCollection:
+        # there is only one screen, so the computer tool is shared between sessions
+        return ToolCollection(computer, self.bash, self.edit)
+
+    def close(self):
+        """Terminate the session's shells; must be called on the loop they run on."""
+        self.bash.close()
+
+
+class SessionStore:
+    """
+    Sessions by id. A session that has been idle for `idle_timeout` seconds is
+    expired, and so is the least recently used idle one when there are more than
+    `max_sessions`. Expired sessions are handed back by `expire` to be closed.
+    """
+
+    def __init__(self, idle_timeout: float = 30 * 60, max_sessions: int = 16):
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self._sessions: OrderedDict[str, Session] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def checkout(self, session_id: str | None) -> Session | None:
+        """
+        Mark a session as running and return it, creating a new one if `session_id`
+        is unknown or has expired. Return None if the session is already running.
+        """
+        with self._lock:
+            session = self._sessions.get(session_id) if session_id else None
+            if session is None:
+                session = Session(secrets.token_urlsafe(16))
+                self._sessions[session.id] = session
+            elif session.running:
+                return None
+            self._sessions.move_to_end(session.id)
+            session.running = True
+            return session
+
+    def checkin(self, session: Session):
+        """Mark a session as idle again."""
+        with self._lock:
+            session.running = False
+            session.last_used = time.monotonic()
+
+    def expire(self) -> list[Session]:
+        """Forget the sessions that are due to expire, and return them."""
+        expired = []
+        now = time.monotonic()
+        with self._lock:
+            idle = [
+                session for session in self._sessions.values() if not session.running
+            ]
+            n_excess = len(self._sessions) - self.max_sessions
+            for session in idle:
+                if n_excess > 0 or now - session.last_used > self.idle_timeout:
+                    del self._sessions[session.id]
+                    expired.append(session)
+                    n_excess -= 1
+        return expired
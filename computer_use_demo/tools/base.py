@@ -1,5 +1,7 @@
+import base64
 from abc import ABCMeta, abstractmethod
 from dataclasses import dataclass, fields, replace
+from functools import cached_property
 from typing import Any
 
 from anthropic.types.beta import BetaToolUnionParam
@@ -19,16 +21,48 @@ class BaseAnthropicTool(metaclass=ABCMeta):
     ) -> BetaToolUnionParam:
         raise NotImplementedError
 
+    def lock_key(self, **kwargs) -> str | None:
+        """
+        Returns the key of the resource a call with the given arguments uses. Calls
+        sharing a key run one at a time, in the order they were issued, while calls
+        with different keys may run concurrently. By default all calls to a tool are
+        serialized.
+        """
+        return self.to_params()["name"]
+
+    def workspace_access(self, **kwargs) -> str | None:
+        """
+        Returns the kind of access a call with the given arguments has to the shared
+        workspace (files and processes), or None if it does not touch it. Calls with
+        the same kind of access may run concurrently, but a call with another kind
+        waits until all earlier ones have finished, so for instance a file edit
+        never overtakes a bash command issued before it.
+        """
+        return None
+
+    def action_name(self, **kwargs) -> str | None:
+        """Returns the action a call with the given arguments performs, for metrics."""
+        return None
+
 
 @dataclass(kw_only=True, frozen=True)
 class ToolResult:
-    """Represents the result of a tool execution."""
+    """
+    Represents the result of a tool execution. `image` holds the encoded image bytes
+    (e.g. a PNG file); their base64 form is only computed when it is first needed.
+    """
 
     output: str | None = None
     error: str | None = None
-    base64_image: str | None = None
+    image: bytes | memoryview | None = None
+    image_media_type: str | None = None
     system: str | None = None
 
+    @cached_property
+    def base64_image(self) -> str | None:
+        """The image as base64, computed once (e.g. for the API payload) and cached."""
+        return base64.b64encode(self.image).decode() if self.image else None
+
     def __bool__(self):
         return any(getattr(self, field.name) for field in fields(self))
 
@@ -45,7 +79,8 @@ class ToolResult:
         return ToolResult(
             output=combine_fields(self.output, other.output),
             error=combine_fields(self.error, other.error),
-            base64_image=combine_fields(self.base64_image, other.base64_image, False),
+            image=combine_fields(self.image, other.image, False),
+            image_media_type=self.image_media_type or other.image_media_type,
             system=combine_fields(self.system, other.system),
         )
 
@@ -1,12 +1,102 @@
 import asyncio
+import itertools
 import os
+import tempfile
+import time
+from collections import deque
+from dataclasses import dataclass
 from typing import ClassVar, Literal
 
 from anthropic.types.beta import BetaToolBash20241022Param
 
+from .. import tracing
 from .base import BaseAnthropicTool, CLIResult, ToolError, ToolResult
 
 
+class _OutputBuffer:
+    """
+    Bounded buffer for one output stream of a command. The first and last bytes are
+    kept in memory; once the output outgrows them, all of it is written to a
+    temporary file instead, so memory stays flat however much a command prints.
+    """
+
+    def __init__(self, head_size: int, tail_size: int):
+        self._head_size = head_size
+        self._tail_size = tail_size
+        self._head = bytearray()
+        self._tail = bytearray()
+        self._spill = None
+        self.size = 0
+        self.spill_path: str | None = None
+
+    def write(self, data: bytes | bytearray):
+        self.size += len(data)
+        if self._spill is not None:
+            self._spill.write(data)
+        room = self._head_size - len(self._head)
+        if room > 0:
+            self._head += data[:room]
+            data = data[room:]
+        self._tail += data
+        if len(self._tail) > self._tail_size:
+            if self._spill is None:
+                # nothing has been dropped yet, so head and tail hold all the output
+                self._spill = tempfile.NamedTemporaryFile(
+                    prefix="bash_output_", suffix=".log", delete=False
+                )
+                self._spill.write(self._head)
+                self._spill.write(self._tail)
+                self.spill_path = self._spill.name
+            del self._tail[: -self._tail_size]
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+
+    def getvalue(self) -> str:
+        if self._spill is None:
+            return (self._head + self._tail).decode(errors="replace")
+        omitted = self.size - len(self._head) - len(self._tail)
+        return (
+            self._head.decode(errors="replace")
+            + f"\n<response clipped><NOTE>{omitted} bytes omitted. The full output "
+            f"({self.size} bytes) was saved to {self.spill_path}; use `grep -n` or "
+            "`sed -n` to inspect it.</NOTE>\n" + self._tail.decode(errors="replace")
+        )
+
+
+class _SpillFiles:
+    """
+    The spill files of a tool's commands. The model is pointed at a spill file
+    right after its command, so only the most recent `max_files` are kept; older
+    ones are deleted, and the rest when the tool is closed.
+    """
+
+    def __init__(self, max_files: int):
+        self._max_files = max_files
+        self._paths: deque[str] = deque()
+        self._closed = False
+
+    def add(self, path: str):
+        self._paths.append(path)
+        # commands cancelled by closing the tool only finish after it was closed
+        max_files = 0 if self._closed else self._max_files
+        while len(self._paths) > max_files:
+            self._delete(self._paths.popleft())
+
+    def close(self):
+        self._closed = True
+        while self._paths:
+            self._delete(self._paths.popleft())
+
+    @staticmethod
+    def _delete(path: str):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
 class _BashSession:
     """A session of a bash shell."""
 
@@ -14,13 +104,24 @@ class _BashSession:
     _process: asyncio.subprocess.Process
 
     command: str = "/bin/bash"
-    _output_delay: float = 0.2  # seconds
+    _read_size: int = 64 * 1024  # bytes
+    # per stream, output beyond head + tail is only kept in a spill file
+    _output_head_size: int = 8 * 1024  # bytes
+    _output_tail_size: int = 8 * 1024  # bytes
     _timeout: float = 120.0  # seconds
     _sentinel: str = "<<exit>>"
+    _trace_command_chars: int = 200  # how much of a command a trace span shows
 
-    def __init__(self):
+    def __init__(self, spill_files: _SpillFiles, timeout: float | None = None):
         self._started = False
         self._timed_out = False
+        # set if a command was cancelled midway, leaving its output unread
+        self.interrupted = False
+        self._spill_files = spill_files
+        if timeout is not None:
+            self._timeout = timeout
+        # buffers of the command currently running, for peeking at its output
+        self._running_output: tuple[_OutputBuffer, _OutputBuffer] | None = None
 
     async def start(self):
         if self._started:
@@ -65,82 +166,315 @@ class _BashSession:
         assert self._process.stdout
         assert self._process.stderr
 
-        # send command to the process
-        self._process.stdin.write(
-            command.encode() + f"; echo '{self._sentinel}'\n".encode()
-        )
-        await self._process.stdin.drain()
+        with tracing.span(
+            "bash", "bash", command=command[: self._trace_command_chars]
+        ) as span_args:
+            stdout = _OutputBuffer(self._output_head_size, self._output_tail_size)
+            stderr = _OutputBuffer(self._output_head_size, self._output_tail_size)
+            self._running_output = (stdout, stderr)
 
-        # read output from the process, until the sentinel is found
-        try:
-            async with asyncio.timeout(self._timeout):
-                while True:
-                    await asyncio.sleep(self._output_delay)
-                    # if we read directly from stdout/stderr, it will wait forever for
-                    # EOF. use the StreamReader buffer directly instead.
-                    output = (
-                        self._process.stdout._buffer.decode()  # pyright: ignore[reportAttributeAccessIssue]
+            try:
+                # send command to the process, followed by a sentinel on each stream;
+                # the one on stdout carries the command's exit status
+                sentinels = (
+                    f"; echo '{self._sentinel}'$?; echo '{self._sentinel}' >&2\n"
+                )
+                self._process.stdin.write(command.encode() + sentinels.encode())
+                await self._process.stdin.drain()
+
+                # read output from the process, until the sentinels are found
+                async with asyncio.timeout(self._timeout):
+                    status, _ = await asyncio.gather(
+                        self._read_until_sentinel(self._process.stdout, stdout),
+                        self._read_until_sentinel(self._process.stderr, stderr),
                     )
-                    if self._sentinel in output:
-                        # strip the sentinel and break
-                        output = output[: output.index(self._sentinel)]
-                        break
-        except asyncio.TimeoutError:
-            self._timed_out = True
-            raise ToolError(
-                f"timed out: bash has not returned in {self._timeout} seconds and must be restarted",
-            ) from None
+            except asyncio.TimeoutError:
+                self._timed_out = True
+                raise ToolError(
+                    f"timed out: bash has not returned in {self._timeout} seconds and must be restarted",
+                ) from None
+            except asyncio.CancelledError:
+                # the rest of the output would be read by the next command instead
+                self.interrupted = True
+                self.stop()
+                raise
+            finally:
+                self._running_output = None
+                stdout.close()
+                stderr.close()
+                for buffer in (stdout, stderr):
+                    if buffer.spill_path is not None:
+                        self._spill_files.add(buffer.spill_path)
+                span_args.update(stdout_bytes=stdout.size, stderr_bytes=stderr.size)
 
-        if output.endswith("\n"):
-            output = output[:-1]
+        output = stdout.getvalue()
+        error = stderr.getvalue()
+
+        if status is None:
+            # the shell exited before printing the sentinel, e.g. on `exit`
+            returncode = await self._process.wait()
+            return CLIResult(
+                output=output.removesuffix("\n"),
+                error=error.removesuffix("\n"),
+                system="tool must be restarted",
+            ) + ToolResult(error=f"bash has exited with returncode {returncode}")
 
-        error = (
-            self._process.stderr._buffer.decode()  # pyright: ignore[reportAttributeAccessIssue]
+        return CLIResult(
+            output=output.removesuffix("\n"),
+            error=error.removesuffix("\n"),
+            system=f"exit status {status}" if status != "0" else None,
         )
-        if error.endswith("\n"):
-            error = error[:-1]
 
-        # clear the buffers so that the next output can be read correctly
-        self._process.stdout._buffer.clear()  # pyright: ignore[reportAttributeAccessIssue]
-        self._process.stderr._buffer.clear()  # pyright: ignore[reportAttributeAccessIssue]
+    def peek(self) -> CLIResult | None:
+        """Output so far of the command currently running, if any."""
+        if self._running_output is None:
+            return None
+        stdout, stderr = self._running_output
+        return CLIResult(output=stdout.getvalue(), error=stderr.getvalue())
+
+    async def _read_until_sentinel(
+        self, stream: asyncio.StreamReader, buffer: _OutputBuffer
+    ) -> str | None:
+        """
+        Read a stream as data arrives into `buffer` until the sentinel line is seen,
+        and return the rest of the sentinel line, or None if the stream ended first.
+        """
+        sentinel = self._sentinel.encode()
+        # data not yet handed to the buffer: at most a chunk plus the few bytes
+        # that could be the start of a sentinel split across chunks
+        pending = bytearray()
+        while True:
+            chunk = await stream.read(self._read_size)
+            if not chunk:
+                buffer.write(pending)
+                return None
+            pending += chunk
+            index = pending.find(sentinel)
+            if index == -1:
+                keep = min(len(sentinel) - 1, len(pending))
+                buffer.write(pending[: len(pending) - keep])
+                del pending[: len(pending) - keep]
+                continue
+            buffer.write(pending[:index])
+            del pending[:index]
+            line_end = pending.find(b"\n", len(sentinel))
+            if line_end != -1:
+                return pending[len(sentinel) : line_end].decode()
+
+
+@dataclass
+class _BackgroundJob:
+    """A command running in its own session, started with `background=True`."""
 
-        return CLIResult(output=output, error=error)
+    command: str
+    session: _BashSession
+    task: asyncio.Task[ToolResult]
+    started_at: float
+    # whether its shell has been stopped, once the command finished
+    released: bool = False
+
+
+async def _run_job(job_id: str, session: _BashSession, command: str) -> ToolResult:
+    # a job outlives the tool call that started it, so it is traced on its own track
+    with tracing.span(job_id, "bash", own_track=True):
+        return await session.run(command)
 
 
 class BashTool(BaseAnthropicTool):
     """
     A tool that allows the agent to run bash commands.
     The tool parameters are defined by Anthropic and are not editable.
+
+    Besides the Anthropic-defined parameters, the tool accepts a few optional ones:
+    `session` names the shell to run in (each one keeps its own state, and sessions
+    run concurrently), `timeout` sets the timeout of a session when it is started
+    or restarted, or of a background job, `background` runs the command as a job in
+    a session of its own and returns a job handle straight away, and `job` polls
+    such a job for its status and output.
     """
 
-    _session: _BashSession | None
+    _sessions: dict[str, _BashSession]
+    _jobs: dict[str, _BackgroundJob]
     name: ClassVar[Literal["bash"]] = "bash"
     api_type: ClassVar[Literal["bash_20241022"]] = "bash_20241022"
 
+    default_session: ClassVar[str] = "default"
+    _max_sessions: int = 8
+    _background_timeout: float = 3600.0  # seconds
+    _max_spill_files: int = 16
+
     def __init__(self):
-        self._session = None
+        self._sessions = {}
+        self._jobs = {}
+        self._job_ids = itertools.count(1)
+        self._spill_files = _SpillFiles(self._max_spill_files)
         super().__init__()
 
+    def lock_key(
+        self,
+        *,
+        session: str = default_session,
+        background: bool = False,
+        job: str | None = None,
+        **kwargs,
+    ) -> str | None:
+        # background jobs get a session of their own, and polling does not touch one
+        if background or job is not None:
+            return None
+        return f"{self.name}:{session}"
+
+    def workspace_access(self, *, job: str | None = None, **kwargs) -> str | None:
+        # commands in different sessions may overlap each other, but not file edits
+        return None if job is not None else "bash"
+
+    def action_name(
+        self,
+        *,
+        restart: bool = False,
+        background: bool = False,
+        job: str | None = None,
+        **kwargs,
+    ) -> str | None:
+        # not the command itself, which would make a label value per command
+        if job is not None:
+            return "poll"
+        if restart:
+            return "restart"
+        return "background" if background else "run"
+
     async def __call__(
-        self, command: str | None = None, restart: bool = False, **kwargs
+        self,
+        command: str | None = None,
+        restart: bool = False,
+        session: str = default_session,
+        background: bool = False,
+        job: str | None = None,
+        timeout: float | None = None,
+        **kwargs,
     ):
         print("### Running bash command:", command)
+        if job is not None:
+            return self._poll_job(job)
+
+        if timeout is not None:
+            if not isinstance(timeout, int | float) or isinstance(timeout, bool):
+                raise ToolError(
+                    f"timeout must be a number of seconds, not {timeout!r}."
+                )
+            if not timeout > 0:
+                raise ToolError(f"timeout must be positive, not {timeout!r}.")
+            if not restart and not background and session in self._sessions:
+                raise ToolError(
+                    f"timeout only applies to a new session; session {session!r} is "
+                    "already open, restart it to change its timeout."
+                )
+
         if restart:
-            if self._session:
-                self._session.stop()
-            self._session = _BashSession()
-            await self._session.start()
+            if old_session := self._sessions.pop(session, None):
+                old_session.stop()
+            await self._start_session(session, timeout)
 
             return ToolResult(system="tool has been restarted.")
 
-        if self._session is None:
-            self._session = _BashSession()
-            await self._session.start()
+        if command is None:
+            raise ToolError("no command provided.")
+
+        if background:
+            self._check_session_limit("a background job")
+            job_id = f"job-{next(self._job_ids)}"
+            job_session = _BashSession(
+                self._spill_files, timeout or self._background_timeout
+            )
+            await job_session.start()
+            self._jobs[job_id] = _BackgroundJob(
+                command=command,
+                session=job_session,
+                task=asyncio.create_task(_run_job(job_id, job_session, command)),
+                started_at=time.monotonic(),
+            )
+            return ToolResult(
+                output=f"Started background job {job_id}. Poll it with job={job_id!r}."
+            )
+
+        bash_session = self._sessions.get(session)
+        interrupted = bash_session is not None and bash_session.interrupted
+        if bash_session is None or interrupted:
+            self._sessions.pop(session, None)
+            bash_session = await self._start_session(session, timeout)
+        result = await bash_session.run(command)
+        if interrupted:
+            status = (
+                f"session {session!r} was restarted, as its previous command was "
+                "interrupted"
+            )
+            result = result.replace(
+                system=f"{status}; {result.system}" if result.system else status
+            )
+        return result
+
+    def close(self):
+        """Terminate all sessions and background jobs, and delete their spill files."""
+        for bash_session in self._sessions.values():
+            bash_session.stop()
+        for job in self._jobs.values():
+            job.task.cancel()
+            if not job.released:
+                job.session.stop()
+        self._sessions.clear()
+        self._jobs.clear()
+        self._spill_files.close()
+        self._spill_files = _SpillFiles(self._max_spill_files)
+
+    async def _start_session(self, session: str, timeout: float | None) -> _BashSession:
+        self._check_session_limit(f"session {session!r}")
+        bash_session = _BashSession(self._spill_files, timeout)
+        await bash_session.start()
+        self._sessions[session] = bash_session
+        return bash_session
+
+    def _check_session_limit(self, starting: str):
+        """Raise if no other shell can be started, counting sessions and running jobs."""
+        self._release_finished_jobs()
+        running_jobs = [
+            job_id for job_id, job in self._jobs.items() if not job.released
+        ]
+        if len(self._sessions) + len(running_jobs) >= self._max_sessions:
+            raise ToolError(
+                f"cannot start {starting}: {self._max_sessions} sessions are "
+                f"already open ({', '.join([*self._sessions, *running_jobs])})."
+            )
 
-        if command is not None:
-            return await self._session.run(command)
+    def _release_finished_jobs(self):
+        """Stop the shells of finished jobs; their results are kept until polled."""
+        for job in self._jobs.values():
+            if job.task.done() and not job.released:
+                job.session.stop()
+                job.released = True
 
-        raise ToolError("no command provided.")
+    def _poll_job(self, job_id: str) -> ToolResult:
+        job = self._jobs.get(job_id)
+        if job is None:
+            raise ToolError(f"no background job {job_id!r}.")
+        elapsed = time.monotonic() - job.started_at
+
+        if not job.task.done():
+            status = (
+                f"job {job_id} (`{job.command}`) is still running after {elapsed:.0f}s"
+            )
+            return (job.session.peek() or CLIResult()).replace(system=status)
+
+        # finished jobs are reported once, then their session is released
+        del self._jobs[job_id]
+        if not job.released:
+            job.session.stop()
+        status = f"job {job_id} (`{job.command}`) finished"
+        try:
+            result = job.task.result()
+        except ToolError as e:
+            return ToolResult(system=status, error=e.message)
+        return result.replace(
+            system=f"{status}; {result.system}" if result.system else status
+        )
 
     def to_params(self) -> BetaToolBash20241022Param:
         return {
@@ -1,9 +1,11 @@
 """Collection classes for managing multiple tools."""
 
+import asyncio
 from typing import Any
 
 from anthropic.types.beta import BetaToolUnionParam
 
+from .. import metrics, tracing
 from .base import (
     BaseAnthropicTool,
     ToolError,
@@ -18,6 +20,13 @@ class ToolCollection:
     def __init__(self, *tools: BaseAnthropicTool):
         self.tools = tools
         self.tool_map = {tool.to_params()["name"]: tool for tool in tools}
+        # the most recently submitted call for each lock key
+        self._pending: dict[str, asyncio.Task[ToolResult]] = {}
+        # the kind of workspace access of the latest calls, the unfinished calls
+        # with that kind and the ones they wait for (see `workspace_access`)
+        self._access: str | None = None
+        self._access_group: list[asyncio.Task[ToolResult]] = []
+        self._access_waits: list[asyncio.Task[ToolResult]] = []
 
     def to_params(
         self,
@@ -28,7 +37,63 @@ class ToolCollection:
         tool = self.tool_map.get(name)
         if not tool:
             return ToolFailure(error=f"Tool {name} is invalid")
-        try:
-            return await tool(**tool_input)
-        except ToolError as e:
-            return ToolFailure(error=e.message)
+        action = tool.action_name(**tool_input) or ""
+        # tool calls run concurrently with the loop and each other, so each one is
+        # drawn on a track of its own
+        with metrics.TOOL_LATENCY.time(tool=name, action=action), tracing.span(
+            name, "tool", own_track=True, action=action
+        ) as span_args:
+            try:
+                result = await tool(**tool_input)
+            except ToolError as e:
+                result = ToolFailure(error=e.message)
+            span_args.update(
+                output_chars=len(result.output or ""),
+                error=result.error,
+                image_bytes=len(result.image) if result.image else 0,
+            )
+            return result
+
+    def submit(
+        self, *, name: str, tool_input: dict[str, Any]
+    ) -> asyncio.Task[ToolResult]:
+        """
+        Schedule a tool call and return the task running it. Calls that conflict (see
+        `BaseAnthropicTool.lock_key` and `BaseAnthropicTool.workspace_access`) run in
+        submission order; others run concurrently.
+        """
+        tool = self.tool_map.get(name)
+        key = tool.lock_key(**tool_input) if tool else None
+        access = tool.workspace_access(**tool_input) if tool else None
+        waits = []
+        if key is not None and key in self._pending:
+            waits.append(self._pending[key])
+        if access is not None:
+            if access != self._access:
+                # a different kind of access waits for all of the previous kind
+                self._access = access
+                self._access_waits = self._access_group
+                self._access_group = []
+            waits.extend(task for task in self._access_waits if not task.done())
+        task = asyncio.create_task(self._run_after(waits, name, tool_input))
+        if key is not None:
+            self._pending[key] = task
+            task.add_done_callback(lambda _: self._release(key, task))
+        if access is not None:
+            self._access_group = [t for t in self._access_group if not t.done()]
+            self._access_group.append(task)
+        return task
+
+    async def _run_after(
+        self,
+        waits: list[asyncio.Task[ToolResult]],
+        name: str,
+        tool_input: dict[str, Any],
+    ) -> ToolResult:
+        if waits:
+            await asyncio.wait(waits)
+        return await self.run(name=name, tool_input=tool_input)
+
+    def _release(self, key: str, task: asyncio.Task[ToolResult]):
+        if self._pending.get(key) is task:
+            del self._pending[key]
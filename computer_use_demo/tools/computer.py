@@ -1,11 +1,14 @@
 import asyncio
-import base64
 import io
+import time
 from enum import StrEnum
-from typing import Literal, TypedDict
+from typing import Literal, TypedDict, cast
+import numpy as np
 import pyautogui
 from anthropic.types.beta import BetaToolComputerUse20241022Param
+from PIL import Image
 
+from .. import metrics, tracing
 from .base import BaseAnthropicTool, ToolError, ToolResult
 
 OUTPUT_DIR = "/tmp/outputs"
@@ -26,12 +29,41 @@ Action = Literal[
     "cursor_position",
 ]
 
+# actions after which the screen may still be redrawing (a plain mouse move at most
+# brings up a hover effect, which is not worth waiting for)
+INPUT_ACTIONS: frozenset[Action] = frozenset(
+    {
+        "key",
+        "type",
+        "left_click",
+        "left_click_drag",
+        "right_click",
+        "middle_click",
+        "double_click",
+    }
+)
+
 
 class ScalingSource(StrEnum):
     COMPUTER = "computer"
     API = "api"
 
 
+class ScreenshotFormat(StrEnum):
+    PNG = "png"  # smallest lossless output, but the optimize pass is slow
+    PNG_FAST = "png_fast"  # lossless with a low compression level
+    JPEG = "jpeg"
+    WEBP = "webp"
+
+
+SCREENSHOT_MEDIA_TYPES: dict[ScreenshotFormat, str] = {
+    ScreenshotFormat.PNG: "image/png",
+    ScreenshotFormat.PNG_FAST: "image/png",
+    ScreenshotFormat.JPEG: "image/jpeg",
+    ScreenshotFormat.WEBP: "image/webp",
+}
+
+
 class ComputerToolOptions(TypedDict):
     display_height_px: int
     display_width_px: int
@@ -54,8 +86,23 @@ class ComputerTool(BaseAnthropicTool):
     height: int
     display_num: int | None
 
-    _screenshot_delay = 1.0
+    _screenshot_delay = 1.0  # longest wait for the screen to settle after input
+    _settle_poll_interval = 0.05  # shortest time between settle captures, seconds
+    _settle_downscale = 8
+    # the screen is settled once less than this fraction of pixels changes
+    # between consecutive low resolution frames
+    _settle_max_changed_fraction = 0.001
     _scaling_enabled = True
+    _png_fast_compress_level = 1
+    # a grayscale pixel counts as changed when it differs by more than this
+    _pixel_change_tolerance = 8
+    # a frame with at most this many changed pixels is treated as unchanged
+    _unchanged_max_pixels = 0
+    # with region screenshots, every nth frame is sent in full to keep the model
+    # anchored, as is any frame whose changed region covers most of the screen
+    _full_frame_interval = 5
+    _max_region_fraction = 0.5
+    _region_padding = 16  # pixels, in API coordinates
 
     @property
     def options(self) -> ComputerToolOptions:
@@ -68,9 +115,38 @@ class ComputerTool(BaseAnthropicTool):
     def to_params(self) -> BetaToolComputerUse20241022Param:
         return {"name": self.name, "type": self.api_type, **self.options}
 
-    def __init__(self):
+    def __init__(
+        self,
+        screenshot_format: ScreenshotFormat = ScreenshotFormat.PNG,
+        screenshot_quality: int = 80,
+        dedupe_screenshots: bool = True,
+        region_screenshots: bool = False,
+        wait_for_settle: bool = True,
+    ):
+        """
+        `screenshot_quality` (1-100) applies to the lossy JPEG and WebP formats. With
+        `dedupe_screenshots`, a screenshot identical to the last one sent is replaced
+        by a short text result. With `region_screenshots`, only the bounding box of
+        what changed since the last frame sent is returned, along with its offset.
+        With `wait_for_settle`, a screenshot taken shortly after an input action is
+        only captured once the screen stops changing.
+        """
         super().__init__()
 
+        self.screenshot_format = ScreenshotFormat(screenshot_format)
+        self.screenshot_quality = screenshot_quality
+        self.dedupe_screenshots = dedupe_screenshots
+        self.region_screenshots = region_screenshots
+        # grayscale copy of the last frame sent to the model
+        self._last_frame: np.ndarray | None = None
+        self._frames_since_full_frame = 0
+        self.wait_for_settle = wait_for_settle
+        # seconds the last screenshot waited for the screen to settle
+        self.last_settle_time: float | None = None
+        # when the screen must have settled after the last input action, until the
+        # next screenshot
+        self._settle_deadline: float | None = None
+
         self.width = int(pyautogui.size()[0])
         self.height = int(pyautogui.size()[1])
 
@@ -86,6 +162,15 @@ class ComputerTool(BaseAnthropicTool):
             self.target_width = self.width
             self.target_height = self.height
 
+    def action_name(self, *, action: str | None = None, **kwargs) -> str | None:
+        return action
+
+    def reset(self):
+        """Forget the frames sent so far, e.g. before starting a new conversation."""
+        self._last_frame = None
+        self._frames_since_full_frame = 0
+        self._settle_deadline = None
+
     async def __call__(
         self,
         *,
@@ -93,6 +178,22 @@ class ComputerTool(BaseAnthropicTool):
         text: str | None = None,
         coordinate: list[int] | None = None,
         **kwargs,
+    ):
+        result = await self._run_action(
+            action=action, text=text, coordinate=coordinate, **kwargs
+        )
+        if self.wait_for_settle and action in INPUT_ACTIONS:
+            # the wait happens lazily, only if a screenshot follows soon enough
+            self._settle_deadline = time.monotonic() + self._screenshot_delay
+        return result
+
+    async def _run_action(
+        self,
+        *,
+        action: Action,
+        text: str | None = None,
+        coordinate: list[int] | None = None,
+        **kwargs,
     ):
         print(
             f"### Performing action: {action}{f", text: {text}" if text else ''}{f", coordinate: {coordinate}" if coordinate else ''}"
@@ -199,20 +300,184 @@ class ComputerTool(BaseAnthropicTool):
         raise ToolError(f"Invalid action: {action}")
 
     async def screenshot(self):
-        """Take a screenshot of the current screen and return the base64 encoded image."""
+        """Take a screenshot of the current screen and return the encoded image."""
         # Capture screenshot using PyAutoGUI
-        screenshot = await asyncio.to_thread(pyautogui.screenshot)
+        if self._settle_deadline is not None:
+            screenshot = await self._capture_settled()
+        else:
+            screenshot, _ = await self._capture()
+
+        # resizing and encoding are CPU bound, keep them off the event loop
+        return await asyncio.to_thread(self._process_screenshot, screenshot)
 
+    def _process_screenshot(self, screenshot: Image.Image) -> ToolResult:
+        """
+        Scale a captured frame and turn it into a tool result: the full frame, only
+        the region that changed since the last frame sent, or a note that nothing
+        changed.
+        """
         if self._scaling_enabled and self.scale_factor < 1.0:
-            screenshot = screenshot.resize((self.target_width, self.target_height))
+            with metrics.SCREENSHOT_STAGE_LATENCY.time(stage="resize"), tracing.span(
+                "resize", "screenshot", size=f"{self.target_width}x{self.target_height}"
+            ):
+                screenshot = screenshot.resize((self.target_width, self.target_height))
+
+        changed = None
+        if self.dedupe_screenshots or self.region_screenshots:
+            with tracing.span("compare", "screenshot"):
+                frame = np.asarray(screenshot.convert("L"))
+                changed = self._changed_pixels(frame)
+            if (
+                self.dedupe_screenshots
+                and changed is not None
+                and int(np.count_nonzero(changed)) <= self._unchanged_max_pixels
+            ):
+                return ToolResult(
+                    output="The screen has not changed since the previous screenshot."
+                )
+            self._last_frame = frame
+
+        if (
+            self.region_screenshots
+            and changed is not None
+            and self._frames_since_full_frame < self._full_frame_interval - 1
+            and (box := self._changed_box(changed)) is not None
+        ):
+            self._frames_since_full_frame += 1
+            x0, y0, x1, y1 = box
+            return ToolResult(
+                output=(
+                    "Only the region of the screen that changed since the previous "
+                    f"screenshot is shown: x={x0}, y={y0}, width={x1 - x0}, "
+                    f"height={y1 - y0}. Add x and y to positions in this image to get "
+                    "screen coordinates."
+                ),
+                image=self._encode_screenshot(screenshot.crop(box)),
+                image_media_type=SCREENSHOT_MEDIA_TYPES[self.screenshot_format],
+            )
 
+        self._frames_since_full_frame = 0
+        return ToolResult(
+            image=self._encode_screenshot(screenshot),
+            image_media_type=SCREENSHOT_MEDIA_TYPES[self.screenshot_format],
+        )
+
+    def _changed_pixels(self, frame: np.ndarray) -> np.ndarray | None:
+        """
+        Compare a grayscale frame against the last frame sent to the model and return
+        the mask of changed pixels, or None if there is nothing to compare against.
+        """
+        last_frame = self._last_frame
+        if last_frame is None or last_frame.shape != frame.shape:
+            return None
+        return (
+            np.abs(frame.astype(np.int16) - last_frame) > self._pixel_change_tolerance
+        )
+
+    def _changed_box(self, changed: np.ndarray) -> tuple[int, int, int, int] | None:
+        """
+        Padded bounding box (left, top, right, bottom) of the changed pixels, or None
+        if nothing changed or the change is too large to be worth cropping.
+        """
+        rows = np.flatnonzero(changed.any(axis=1))
+        cols = np.flatnonzero(changed.any(axis=0))
+        if not len(rows):
+            return None
+        height, width = changed.shape
+        x0 = max(int(cols[0]) - self._region_padding, 0)
+        y0 = max(int(rows[0]) - self._region_padding, 0)
+        x1 = min(int(cols[-1]) + 1 + self._region_padding, width)
+        y1 = min(int(rows[-1]) + 1 + self._region_padding, height)
+        if (x1 - x0) * (y1 - y0) > self._max_region_fraction * width * height:
+            return None
+        return x0, y0, x1, y1
+
+    def _encode_screenshot(self, screenshot: Image.Image) -> memoryview:
+        """Encode a frame in the configured format."""
+        with metrics.SCREENSHOT_STAGE_LATENCY.time(stage="encode"), tracing.span(
+            "encode", "screenshot", format=str(self.screenshot_format)
+        ) as span_args:
+            image = self._encode(screenshot)
+            span_args["image_bytes"] = len(image)
+            return image
+
+    def _encode(self, screenshot: Image.Image) -> memoryview:
         img_buffer = io.BytesIO()
         # Save the image to an in-memory buffer
-        screenshot.save(img_buffer, format="PNG", optimize=True)
-        img_buffer.seek(0)
-        base64_image = base64.b64encode(img_buffer.read()).decode()
-
-        return ToolResult(base64_image=base64_image)
+        if self.screenshot_format == ScreenshotFormat.PNG:
+            screenshot.save(img_buffer, format="PNG", optimize=True)
+        elif self.screenshot_format == ScreenshotFormat.PNG_FAST:
+            screenshot.save(
+                img_buffer, format="PNG", compress_level=self._png_fast_compress_level
+            )
+        elif self.screenshot_format == ScreenshotFormat.JPEG:
+            screenshot.convert("RGB").save(
+                img_buffer, format="JPEG", quality=self.screenshot_quality
+            )
+        elif self.screenshot_format == ScreenshotFormat.WEBP:
+            screenshot.save(
+                img_buffer, format="WEBP", quality=self.screenshot_quality, method=0
+            )
+        # a view of the buffer avoids copying the encoded image
+        return img_buffer.getbuffer()
+
+    async def _capture(
+        self, compare: bool = False
+    ) -> tuple[Image.Image, np.ndarray | None]:
+        """
+        Capture the screen, and with `compare` also a small grayscale copy to compare
+        against the previous capture while waiting for the screen to settle.
+        """
+
+        def capture():
+            screenshot = pyautogui.screenshot()
+            if not compare:
+                return screenshot, None
+            small = screenshot.convert("L").reduce(self._settle_downscale)
+            return screenshot, np.asarray(small)
+
+        with metrics.SCREENSHOT_STAGE_LATENCY.time(stage="capture"), tracing.span(
+            "capture", "screenshot"
+        ) as span_args:
+            screenshot, small = await asyncio.to_thread(capture)
+            span_args["size"] = f"{screenshot.width}x{screenshot.height}"
+        return screenshot, small
+
+    async def _capture_settled(self) -> Image.Image:
+        """
+        Capture the screen once it has settled after the last input action: capture
+        until two consecutive frames barely differ or the deadline set by the input
+        action has passed, and return the last frame. Another capture is only started
+        if it is expected to finish before the deadline, so the wait, captures
+        included, stays within `_screenshot_delay` of the input action.
+        """
+        deadline = cast(float, self._settle_deadline)
+        start = time.monotonic()
+        with metrics.SCREENSHOT_STAGE_LATENCY.time(stage="settle"), tracing.span(
+            "settle", "screenshot"
+        ) as span_args:
+            previous = None
+            while True:
+                captured_at = time.monotonic()
+                screenshot, frame = await self._capture(compare=True)
+                now = time.monotonic()
+                frame = cast(np.ndarray, frame)
+                if previous is not None:
+                    changed = np.count_nonzero(
+                        np.abs(frame.astype(np.int16) - previous)
+                        > self._pixel_change_tolerance
+                    )
+                    if changed < self._settle_max_changed_fraction * frame.size:
+                        break
+                previous = frame
+                next_capture = max(now, captured_at + self._settle_poll_interval)
+                if next_capture + (now - captured_at) > deadline:
+                    break
+                await asyncio.sleep(next_capture - now)
+            self._settle_deadline = None
+            self.last_settle_time = time.monotonic() - start
+            span_args["settle_time"] = self.last_settle_time
+        return screenshot
 
     def scale_coordinates(self, source: ScalingSource, x: int, y: int):
         """Scale coordinates between the assistant's coordinate system and the real screen coordinates."""
@@ -1,11 +1,19 @@
-from collections import defaultdict
+import asyncio
+import locale
+import os
+import stat
+import tempfile
+import time
 from pathlib import Path
 from typing import Literal, get_args
 
 from anthropic.types.beta import BetaToolTextEditor20241022Param
 
 from .base import BaseAnthropicTool, CLIResult, ToolError, ToolResult
-from .run import maybe_truncate, run
+from .history import EditHistory
+from .lines import LineIndex, get_line_index
+from .listing import list_directory
+from .run import MAX_RESPONSE_LEN, maybe_truncate
 
 Command = Literal[
     "view",
@@ -15,6 +23,64 @@ Command = Literal[
     "undo_edit",
 ]
 SNIPPET_LINES: int = 4
+# files at least this large are paged through a line index instead of being read whole
+LINE_INDEX_MIN_SIZE: int = 256 * 1024
+_SCAN_CHUNK: int = 64 * 1024
+
+
+def _expandtabs(text: str) -> str:
+    return text.expandtabs() if "\t" in text else text
+
+
+def _line_start(text: str, pos: int, lines_before: int) -> int:
+    """Offset of the start of the line `lines_before` lines above the one containing `pos`."""
+    for _ in range(lines_before + 1):
+        pos = text.rfind("\n", 0, pos)
+        if pos == -1:
+            return 0
+    return pos + 1
+
+
+def _line_end(text: str, pos: int, lines_after: int) -> int:
+    """Offset of the end of the line `lines_after` lines below the one containing `pos`."""
+    for _ in range(lines_after + 1):
+        pos = text.find("\n", pos)
+        if pos == -1:
+            return len(text)
+        pos += 1
+    return pos - 1
+
+
+def _nth_line_start(text: str, line: int) -> int:
+    """Offset of the start of a (0-based) line, or -1 if the text has fewer lines."""
+    pos = 0
+    # skip whole chunks by counting their newlines, then find the rest one by one
+    while line > 0:
+        chunk_end = pos + _SCAN_CHUNK
+        n_newlines = text.count("\n", pos, chunk_end)
+        if n_newlines < line and chunk_end < len(text):
+            line -= n_newlines
+            pos = chunk_end
+            continue
+        for _ in range(line):
+            pos = text.find("\n", pos) + 1
+            if pos == 0:
+                return -1
+        break
+    return pos
+
+
+class _EditTimer:
+    """Collects the time spent in each stage of an edit."""
+
+    def __init__(self):
+        self.laps: dict[str, float] = {}
+        self._last = time.perf_counter()
+
+    def lap(self, stage: str):
+        now = time.perf_counter()
+        self.laps[stage] = now - self._last
+        self._last = now
 
 
 class EditTool(BaseAnthropicTool):
@@ -26,10 +92,24 @@ class EditTool(BaseAnthropicTool):
     api_type: Literal["text_editor_20241022"] = "text_editor_20241022"
     name: Literal["str_replace_editor"] = "str_replace_editor"
 
-    _file_history: dict[Path, list[str]]
+    _file_history: EditHistory
+    last_edit_timing: dict[str, float]
 
-    def __init__(self):
-        self._file_history = defaultdict(list)
+    def __init__(
+        self,
+        history_max_bytes_per_file: int = 16 * 1024 * 1024,
+        history_max_bytes: int = 64 * 1024 * 1024,
+    ):
+        """
+        The undo history is kept compressed; the limits bound its memory use per
+        file and in total, dropping the oldest entries first.
+        """
+        self._file_history = EditHistory(
+            max_bytes_per_file=history_max_bytes_per_file,
+            max_bytes=history_max_bytes,
+        )
+        # seconds spent in each stage of the last str_replace or insert
+        self.last_edit_timing = {}
         super().__init__()
 
     def to_params(self) -> BetaToolTextEditor20241022Param:
@@ -38,6 +118,17 @@ class EditTool(BaseAnthropicTool):
             "type": self.api_type,
         }
 
+    def lock_key(self, *, path: str | None = None, **kwargs) -> str | None:
+        # calls on different files are independent of each other
+        return f"{self.name}:{path}"
+
+    def workspace_access(self, *, command: str | None = None, **kwargs) -> str | None:
+        # views only wait for earlier bash commands and edits, not for each other
+        return "read" if command == "view" else "write"
+
+    def action_name(self, *, command: str | None = None, **kwargs) -> str | None:
+        return command
+
     async def __call__(
         self,
         *,
@@ -58,7 +149,7 @@ class EditTool(BaseAnthropicTool):
             if not file_text:
                 raise ToolError("Parameter `file_text` is required for command: create")
             self.write_file(_path, file_text)
-            self._file_history[_path].append(file_text)
+            self._file_history.push(_path, file_text)
             return ToolResult(output=f"File created successfully at: {_path}")
         elif command == "str_replace":
             if not old_str:
@@ -114,40 +205,58 @@ class EditTool(BaseAnthropicTool):
                     "The `view_range` parameter is not allowed when `path` points to a directory."
                 )
 
-            _, stdout, stderr = await run(
-                rf"find {path} -maxdepth 2 -not -path '*/\.*'"
-            )
+            listing = await asyncio.to_thread(list_directory, path, MAX_RESPONSE_LEN)
+            stdout = "".join(f"{line}\n" for line in listing.lines)
+            if len(stdout) > MAX_RESPONSE_LEN:
+                n_shown = stdout.count("\n", 0, MAX_RESPONSE_LEN)
+                stdout = (
+                    maybe_truncate(stdout)
+                    + f"\n{listing.n_entries - n_shown} more entries not shown"
+                )
+            stderr = maybe_truncate("".join(f"{line}\n" for line in listing.errors))
             if not stderr:
                 stdout = f"Here's the files and directories up to 2 levels deep in {path}, excluding hidden items:\n{stdout}\n"
             return CLIResult(output=stdout, error=stderr)
 
-        file_content = self.read_file(path)
-        init_line = 1
-        if view_range:
-            if len(view_range) != 2 or not all(isinstance(i, int) for i in view_range):
-                raise ToolError(
-                    "Invalid `view_range`. It should be a list of two integers."
-                )
-            file_lines = file_content.split("\n")
+        if not view_range:
+            # only read as much of the file as survives truncation
+            file_content = self.read_file(path, limit=MAX_RESPONSE_LEN + 1)
+            return CLIResult(output=self._make_output(file_content, str(path)))
+
+        if len(view_range) != 2 or not all(isinstance(i, int) for i in view_range):
+            raise ToolError(
+                "Invalid `view_range`. It should be a list of two integers."
+            )
+        line_index = await asyncio.to_thread(self._line_index, path)
+        if line_index is None:
+            file_lines = self.read_file(path).split("\n")
             n_lines_file = len(file_lines)
-            init_line, final_line = view_range
-            if init_line < 1 or init_line > n_lines_file:
-                raise ToolError(
-                    f"Invalid `view_range`: {view_range}. It's first element `{init_line}` should be within the range of lines of the file: {[1, n_lines_file]}"
-                )
-            if final_line > n_lines_file:
-                raise ToolError(
-                    f"Invalid `view_range`: {view_range}. It's second element `{final_line}` should be smaller than the number of lines in the file: `{n_lines_file}`"
-                )
-            if final_line != -1 and final_line < init_line:
-                raise ToolError(
-                    f"Invalid `view_range`: {view_range}. It's second element `{final_line}` should be larger or equal than its first `{init_line}`"
-                )
+        else:
+            n_lines_file = line_index.n_lines
+        init_line, final_line = view_range
+        if init_line < 1 or init_line > n_lines_file:
+            raise ToolError(
+                f"Invalid `view_range`: {view_range}. It's first element `{init_line}` should be within the range of lines of the file: {[1, n_lines_file]}"
+            )
+        if final_line > n_lines_file:
+            raise ToolError(
+                f"Invalid `view_range`: {view_range}. It's second element `{final_line}` should be smaller than the number of lines in the file: `{n_lines_file}`"
+            )
+        if final_line != -1 and final_line < init_line:
+            raise ToolError(
+                f"Invalid `view_range`: {view_range}. It's second element `{final_line}` should be larger or equal than its first `{init_line}`"
+            )
 
-            if final_line == -1:
-                file_content = "\n".join(file_lines[init_line - 1 :])
-            else:
-                file_content = "\n".join(file_lines[init_line - 1 : final_line])
+        if line_index is not None:
+            data = await asyncio.to_thread(line_index.read_lines, init_line, final_line)
+            try:
+                file_content = data.decode(locale.getpreferredencoding(False))
+            except Exception as e:
+                raise ToolError(f"Ran into {e} while trying to read {path}") from None
+        elif final_line == -1:
+            file_content = "\n".join(file_lines[init_line - 1 :])
+        else:
+            file_content = "\n".join(file_lines[init_line - 1 : final_line])
 
         return CLIResult(
             output=self._make_output(file_content, str(path), init_line=init_line)
@@ -155,18 +264,21 @@ class EditTool(BaseAnthropicTool):
 
     def str_replace(self, path: Path, old_str: str, new_str: str | None):
         """Implement the str_replace command, which replaces old_str with new_str in the file content"""
+        timer = _EditTimer()
         # Read the file content
-        file_content = self.read_file(path).expandtabs()
+        file_content = _expandtabs(self.read_file(path))
         old_str = old_str.expandtabs()
         new_str = new_str.expandtabs() if new_str is not None else ""
+        timer.lap("read")
 
         # Check if old_str is unique in the file
-        occurrences = file_content.count(old_str)
-        if occurrences == 0:
+        idx = file_content.find(old_str)
+        if idx == -1:
             raise ToolError(
                 f"No replacement was performed, old_str `{old_str}` did not appear verbatim in {path}."
             )
-        elif occurrences > 1:
+        end = idx + len(old_str)
+        if file_content.find(old_str, end) != -1:
             file_content_lines = file_content.split("\n")
             lines = [
                 idx + 1
@@ -178,19 +290,26 @@ class EditTool(BaseAnthropicTool):
             )
 
         # Replace old_str with new_str
-        new_file_content = file_content.replace(old_str, new_str)
+        new_file_content = file_content[:idx] + new_str + file_content[end:]
+
+        # Create a snippet of the edited section
+        replacement_line = file_content.count("\n", 0, idx)
+        start_line = max(0, replacement_line - SNIPPET_LINES)
+        snippet = (
+            file_content[_line_start(file_content, idx, SNIPPET_LINES) : idx]
+            + new_str
+            + file_content[end : _line_end(file_content, end, SNIPPET_LINES)]
+        )
+        timer.lap("edit")
 
         # Write the new content to the file
         self.write_file(path, new_file_content)
+        timer.lap("write")
 
         # Save the content to history
-        self._file_history[path].append(file_content)
-
-        # Create a snippet of the edited section
-        replacement_line = file_content.split(old_str)[0].count("\n")
-        start_line = max(0, replacement_line - SNIPPET_LINES)
-        end_line = replacement_line + SNIPPET_LINES + new_str.count("\n")
-        snippet = "\n".join(new_file_content.split("\n")[start_line : end_line + 1])
+        self._file_history.push(path, file_content)
+        timer.lap("history")
+        self.last_edit_timing = timer.laps
 
         # Prepare the success message
         success_msg = f"The file {path} has been edited. "
@@ -203,33 +322,42 @@ class EditTool(BaseAnthropicTool):
 
     def insert(self, path: Path, insert_line: int, new_str: str):
         """Implement the insert command, which inserts new_str at the specified line in the file content."""
-        file_text = self.read_file(path).expandtabs()
+        timer = _EditTimer()
+        file_text = _expandtabs(self.read_file(path))
         new_str = new_str.expandtabs()
-        file_text_lines = file_text.split("\n")
-        n_lines_file = len(file_text_lines)
-
-        if insert_line < 0 or insert_line > n_lines_file:
-            raise ToolError(
-                f"Invalid `insert_line` parameter: {insert_line}. It should be within the range of lines of the file: {[0, n_lines_file]}"
-            )
-
-        new_str_lines = new_str.split("\n")
-        new_file_text_lines = (
-            file_text_lines[:insert_line]
-            + new_str_lines
-            + file_text_lines[insert_line:]
-        )
-        snippet_lines = (
-            file_text_lines[max(0, insert_line - SNIPPET_LINES) : insert_line]
-            + new_str_lines
-            + file_text_lines[insert_line : insert_line + SNIPPET_LINES]
-        )
-
-        new_file_text = "\n".join(new_file_text_lines)
-        snippet = "\n".join(snippet_lines)
+        timer.lap("read")
+
+        # offset of the line new_str goes before, or one past the end of the file
+        # when it is appended after the last line
+        offset = _nth_line_start(file_text, insert_line) if insert_line >= 0 else -1
+        if offset == -1:
+            n_lines_file = file_text.count("\n") + 1
+            if insert_line != n_lines_file:
+                raise ToolError(
+                    f"Invalid `insert_line` parameter: {insert_line}. It should be within the range of lines of the file: {[0, n_lines_file]}"
+                )
+            offset = len(file_text) + 1
+
+        new_file_text_parts = [new_str]
+        snippet_parts = [new_str]
+        if insert_line > 0:
+            new_file_text_parts.insert(0, file_text[: offset - 1])
+            snippet_start = _line_start(file_text, offset - 1, SNIPPET_LINES - 1)
+            snippet_parts.insert(0, file_text[snippet_start : offset - 1])
+        if offset <= len(file_text):
+            new_file_text_parts.append(file_text[offset:])
+            snippet_end = _line_end(file_text, offset, SNIPPET_LINES - 1)
+            snippet_parts.append(file_text[offset:snippet_end])
+
+        new_file_text = "\n".join(new_file_text_parts)
+        snippet = "\n".join(snippet_parts)
+        timer.lap("edit")
 
         self.write_file(path, new_file_text)
-        self._file_history[path].append(file_text)
+        timer.lap("write")
+        self._file_history.push(path, file_text)
+        timer.lap("history")
+        self.last_edit_timing = timer.laps
 
         success_msg = f"The file {path} has been edited. "
         success_msg += self._make_output(
@@ -242,27 +370,64 @@ class EditTool(BaseAnthropicTool):
 
     def undo_edit(self, path: Path):
         """Implement the undo_edit command."""
-        if not self._file_history[path]:
+        old_text = self._file_history.pop(path)
+        if old_text is None:
             raise ToolError(f"No edit history found for {path}.")
 
-        old_text = self._file_history[path].pop()
         self.write_file(path, old_text)
 
         return CLIResult(
             output=f"Last edit to {path} undone successfully. {self._make_output(old_text, str(path))}"
         )
 
-    def read_file(self, path: Path):
-        """Read the content of a file from a given path; raise a ToolError if an error occurs."""
+    def read_file(self, path: Path, limit: int | None = None):
+        """Read the content of a file (or its first `limit` characters) from a given path; raise a ToolError if an error occurs."""
         try:
-            return path.read_text()
+            with path.open() as f:
+                return f.read(limit)
         except Exception as e:
             raise ToolError(f"Ran into {e} while trying to read {path}") from None
 
+    def _line_index(self, path: Path) -> LineIndex | None:
+        """Return a line index for paging through a large file, or None if it should be read whole."""
+        try:
+            if path.stat().st_size < LINE_INDEX_MIN_SIZE:
+                return None
+            # byte-level line splitting only works for ASCII-compatible encodings
+            if "\n".encode(locale.getpreferredencoding(False)) != b"\n":
+                return None
+            line_index = get_line_index(path)
+        except Exception as e:
+            raise ToolError(f"Ran into {e} while trying to read {path}") from None
+        # text mode also breaks lines on carriage returns
+        return None if line_index.has_cr else line_index
+
     def write_file(self, path: Path, file: str):
-        """Write the content of a file to a given path; raise a ToolError if an error occurs."""
+        """
+        Write the content of a file to a given path; raise a ToolError if an error occurs.
+        An existing file is replaced atomically, so a failed write leaves it intact.
+        """
         try:
-            path.write_text(file)
+            if not path.exists():
+                path.write_text(file)
+                return
+            target = Path(os.path.realpath(path))
+            with tempfile.NamedTemporaryFile(
+                "w",
+                dir=target.parent,
+                prefix=f".{target.name}.",
+                suffix=".tmp",
+                delete=False,
+            ) as f:
+                try:
+                    f.write(file)
+                    f.flush()
+                    os.fsync(f.fileno())
+                    os.chmod(f.name, stat.S_IMODE(target.stat().st_mode))
+                except BaseException:
+                    os.unlink(f.name)
+                    raise
+            os.replace(f.name, target)
         except Exception as e:
             raise ToolError(f"Ran into {e} while trying to write to {path}") from None
 
@@ -0,0 +1,147 @@
+"""Compact, bounded undo history for the edit tool."""
+
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+
+_COMPRESSION_LEVEL = 1
+_COMPARE_CHUNK = 4096
+
+
+def _compress(text: str) -> bytes:
+    return zlib.compress(text.encode("utf-8", "surrogatepass"), _COMPRESSION_LEVEL)
+
+
+def _decompress(data: bytes) -> str:
+    return zlib.decompress(data).decode("utf-8", "surrogatepass")
+
+
+def _common_prefix_len(a: str, b: str) -> int:
+    """Length of the common prefix of two strings, comparing a chunk at a time."""
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i : i + _COMPARE_CHUNK] == b[i : i + _COMPARE_CHUNK]:
+        i += _COMPARE_CHUNK
+    end = min(i + _COMPARE_CHUNK, n)
+    while i < end and a[i] == b[i]:
+        i += 1
+    return i
+
+
+def _common_suffix_len(a: str, b: str, limit: int) -> int:
+    """Length of the common suffix of two strings, at most `limit`."""
+    la, lb = len(a), len(b)
+    i = 0
+    while (
+        i + _COMPARE_CHUNK <= limit
+        and a[la - i - _COMPARE_CHUNK : la - i] == b[lb - i - _COMPARE_CHUNK : lb - i]
+    ):
+        i += _COMPARE_CHUNK
+    while i < limit and a[la - i - 1] == b[lb - i - 1]:
+        i += 1
+    return i
+
+
+class _FileHistory:
+    """
+    Undo history of a single file. Only the newest entry is stored in full
+    (compressed); every older entry is stored as a reverse diff against the entry
+    after it: the common prefix and suffix lengths and the compressed middle.
+    """
+
+    def __init__(self):
+        self._diffs: list[tuple[int, int, bytes]] = []
+        self._latest: bytes | None = None
+        self.size = 0
+
+    def __len__(self):
+        return len(self._diffs) + (self._latest is not None)
+
+    def push(self, text: str):
+        latest = _compress(text)
+        if self._latest is not None:
+            previous = _decompress(self._latest)
+            prefix = _common_prefix_len(previous, text)
+            suffix = _common_suffix_len(
+                previous, text, min(len(previous), len(text)) - prefix
+            )
+            middle = _compress(previous[prefix : len(previous) - suffix])
+            self._diffs.append((prefix, suffix, middle))
+            self.size += len(middle) - len(self._latest)
+        self._latest = latest
+        self.size += len(latest)
+
+    def pop(self) -> str:
+        assert self._latest is not None
+        text = _decompress(self._latest)
+        self.size -= len(self._latest)
+        self._latest = None
+        if self._diffs:
+            prefix, suffix, middle = self._diffs.pop()
+            previous = text[:prefix] + _decompress(middle) + text[len(text) - suffix :]
+            self._latest = _compress(previous)
+            self.size += len(self._latest) - len(middle)
+        return text
+
+    def drop_oldest(self):
+        if self._diffs:
+            self.size -= len(self._diffs.pop(0)[2])
+        elif self._latest is not None:
+            self.size -= len(self._latest)
+            self._latest = None
+
+
+class EditHistory:
+    """
+    Undo history of all files edited in a session, bounded in memory. When a file's
+    history outgrows `max_bytes_per_file` its oldest entries are dropped, and when
+    the whole history outgrows `max_bytes` entries are dropped from the least
+    recently edited files first. The newest entry of the file being edited is
+    always kept.
+    """
+
+    def __init__(
+        self,
+        max_bytes_per_file: int = 16 * 1024 * 1024,
+        max_bytes: int = 64 * 1024 * 1024,
+    ):
+        self.max_bytes_per_file = max_bytes_per_file
+        self.max_bytes = max_bytes
+        self._files: OrderedDict[Path, _FileHistory] = OrderedDict()
+        self.size = 0
+
+    def __contains__(self, path: Path):
+        return path in self._files
+
+    def push(self, path: Path, text: str):
+        """Record `text` as the newest undo state of `path`."""
+        history = self._files.pop(path, None) or _FileHistory()
+        self._files[path] = history
+        self._resize(history, history.push, text)
+
+        while history.size > self.max_bytes_per_file and len(history) > 1:
+            self._resize(history, history.drop_oldest)
+        while self.size > self.max_bytes:
+            oldest_path, oldest = next(iter(self._files.items()))
+            if oldest is history and len(history) <= 1:
+                break
+            self._resize(oldest, oldest.drop_oldest)
+            if not oldest:
+                del self._files[oldest_path]
+
+    def pop(self, path: Path) -> str | None:
+        """Remove and return the newest undo state of `path`, if there is one."""
+        history = self._files.get(path)
+        if not history:
+            return None
+        text = self._resize(history, history.pop)
+        if not history:
+            del self._files[path]
+        return text
+
+    def _resize(self, history: _FileHistory, operation, *args):
+        """Run an operation on a file history, keeping the total size up to date."""
+        size = history.size
+        result = operation(*args)
+        self.size += history.size - size
+        return result
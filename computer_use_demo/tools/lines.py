@@ -0,0 +1,94 @@
+"""Sparse line-offset index for reading line ranges of large files without loading them."""
+
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+_STRIDE = 256  # lines between checkpoints
+_CHUNK_SIZE = 16 * 1024 * 1024  # bytes scanned at a time while indexing
+_CACHE_SIZE = 32
+
+_cache: OrderedDict[tuple[Path, int, int], "LineIndex"] = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class LineIndex:
+    """
+    Byte offsets of the start of every `_STRIDE`th line of a file, built in one
+    vectorized pass over the file. Reading a range of lines seeks to the nearest
+    checkpoint through an mmap and only scans the lines in between, so it costs the
+    lines actually read, however large the file is.
+
+    Lines are split on b"\\n", so line numbers match `text.split("\\n")` as long as
+    the file has no carriage returns (see `has_cr`), which text mode would also
+    treat as line breaks.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        checkpoints = [0]
+        newlines_seen = 0
+        has_cr = False
+        with open(path, "rb") as f:
+            offset = 0
+            while chunk := f.read(_CHUNK_SIZE):
+                data = np.frombuffer(chunk, dtype=np.uint8)
+                newlines = np.flatnonzero(data == ord("\n"))
+                has_cr = has_cr or bool((data == ord("\r")).any())
+                # line n starts right after the nth newline of the file
+                first = -(newlines_seen + 1) % _STRIDE
+                checkpoints.extend((newlines[first::_STRIDE] + offset + 1).tolist())
+                newlines_seen += len(newlines)
+                offset += len(chunk)
+        self.checkpoints = np.array(checkpoints, dtype=np.int64)
+        self.n_lines = newlines_seen + 1
+        self.size = offset
+        self.has_cr = has_cr
+
+    def read_lines(self, init_line: int, final_line: int) -> bytes:
+        """
+        Return the bytes of lines `init_line` to `final_line` (1-based, inclusive; -1
+        reads to the end of the file), without the trailing newline.
+        """
+        if self.size == 0:
+            return b""
+        with open(self.path, "rb") as f, mmap.mmap(
+            f.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mm:
+            start = self._line_start(mm, init_line - 1)
+            if final_line == -1 or final_line >= self.n_lines:
+                end = len(mm)
+            else:
+                end = self._line_start(mm, final_line) - 1
+            return mm[start:end]
+
+    def _line_start(self, mm: mmap.mmap, line: int) -> int:
+        """Byte offset of the start of a (0-based) line."""
+        checkpoint = line // _STRIDE
+        position = int(self.checkpoints[checkpoint])
+        for _ in range(line - checkpoint * _STRIDE):
+            position = mm.find(b"\n", position) + 1
+        return position
+
+
+def get_line_index(path: Path) -> LineIndex:
+    """Return the line index of a file, reusing it while the file is unchanged."""
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    # indexes are looked up from worker threads, and built outside the lock
+    with _cache_lock:
+        index = _cache.get(key)
+        if index is not None:
+            _cache.move_to_end(key)
+            return index
+    index = LineIndex(path)
+    with _cache_lock:
+        _cache[key] = index
+        _cache.move_to_end(key)
+        while len(_cache) > _CACHE_SIZE:
+            _cache.popitem(last=False)
+    return index
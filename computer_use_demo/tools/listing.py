@@ -0,0 +1,93 @@
+"""In-process, cached directory listing for the edit tool."""
+
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+_MAX_DEPTH = 2
+_CACHE_SIZE = 32
+
+_cache: OrderedDict[tuple[str, int], "DirectoryListing"] = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _stamp(path: str) -> tuple[int, int]:
+    stat = os.lstat(path)
+    return stat.st_mtime_ns, stat.st_ctime_ns
+
+
+class DirectoryListing:
+    """
+    The paths up to two levels below a directory, excluding hidden ones, in the
+    order `find {path} -maxdepth 2 -not -path '*/\\.*'` prints them, along with the
+    errors it would report.
+
+    Only the first `max_chars` or so of the listing are kept; the rest of the tree
+    is still walked to count its entries. Every directory that was opened is
+    stamped with its modification times, so the listing can tell when it is stale.
+    """
+
+    def __init__(self, root: str, max_chars: int):
+        self.root = root
+        self.lines: list[str] = []
+        self.n_entries = 0
+        self.errors: list[str] = []
+        self._stamps: list[tuple[str, tuple[int, int]]] = []
+        n_chars = 0
+        for line in self._walk(root, 0):
+            self.n_entries += 1
+            if n_chars <= max_chars:
+                self.lines.append(line)
+                n_chars += len(line) + 1
+
+    def _walk(self, path: str, depth: int):
+        # like `find -path`, the pattern is matched against the whole path
+        hidden = "/." in path
+        if not hidden:
+            yield path
+        if depth == _MAX_DEPTH:
+            return
+        try:
+            self._stamps.append((path, _stamp(path)))
+            # like `find -P`, a symlink given as the root is not followed
+            if depth == 0 and os.path.islink(path):
+                return
+            with os.scandir(path) as entries:
+                # everything below a hidden directory is hidden too, but find still
+                # opens it and reports it if it can't
+                if hidden:
+                    return
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        yield from self._walk(entry.path, depth + 1)
+                    elif "/." not in entry.path:
+                        yield entry.path
+        except OSError as e:
+            self.errors.append(f"find: {path}: {e.strerror}")
+
+    def is_current(self) -> bool:
+        """Whether none of the listed directories changed since the listing was made."""
+        try:
+            return all(_stamp(path) == stamp for path, stamp in self._stamps)
+        except OSError:
+            return False
+
+
+def list_directory(path: Path, max_chars: int) -> DirectoryListing:
+    """Return the listing of a directory, reusing it while the tree is unchanged."""
+    key = (str(path), max_chars)
+    with _cache_lock:
+        listing = _cache.get(key)
+    if listing is not None and listing.is_current():
+        with _cache_lock:
+            _cache[key] = listing
+            _cache.move_to_end(key)
+        return listing
+    listing = DirectoryListing(str(path), max_chars)
+    with _cache_lock:
+        _cache[key] = listing
+        _cache.move_to_end(key)
+        while len(_cache) > _CACHE_SIZE:
+            _cache.popitem(last=False)
+    return listing
@@ -0,0 +1,167 @@
+"""
+Opt-in timeline tracing of the sampling loop, written as a Chrome Trace Event Format
+file that opens in Perfetto (ui.perfetto.dev) or chrome://tracing.
+
+Tracing is active inside `record`; outside of it `span` does nothing. The tracer is
+kept in a context variable, so it follows the loop into the tasks and threads it
+starts.
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any
+
+_tracer: ContextVar["Tracer | None"] = ContextVar("tracer", default=None)
+# the track (a "thread" in the trace) that spans are drawn on
+_track: ContextVar[int] = ContextVar("track", default=0)
+# the arguments of the innermost span
+_span_args: ContextVar[dict[str, Any] | None] = ContextVar("span_args", default=None)
+
+
+class Tracer:
+    """
+    Collects complete ("X") events. The loop draws on track 0; spans that run
+    concurrently with it, such as tool calls, get a track of their own from a pool,
+    so spans on a track always nest properly.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._pid = os.getpid()
+        self._start = time.perf_counter()
+        self._events: list[dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._free_tracks: list[int] = []
+        self._n_tracks = 0
+        self._name_track(self._new_track(), "sampling loop")
+
+    def now(self) -> float:
+        """Microseconds since the trace started."""
+        return (time.perf_counter() - self._start) * 1e6
+
+    def add_span(self, name: str, category: str, start: float, args: dict[str, Any]):
+        event = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start,
+            "dur": self.now() - start,
+            "pid": self._pid,
+            "tid": _track.get(),
+            "args": args,
+        }
+        with self._lock:
+            self._events.append(event)
+
+    def acquire_track(self) -> int:
+        with self._lock:
+            if self._free_tracks:
+                return self._free_tracks.pop()
+        track = self._new_track()
+        self._name_track(track, f"tools {track}")
+        return track
+
+    def release_track(self, track: int):
+        with self._lock:
+            self._free_tracks.append(track)
+            # hand out the lowest free track first to keep the timeline compact
+            self._free_tracks.sort(reverse=True)
+
+    def write(self):
+        with self._lock:
+            events = list(self._events)
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def _new_track(self) -> int:
+        with self._lock:
+            track = self._n_tracks
+            self._n_tracks += 1
+        return track
+
+    def _name_track(self, track: int, name: str):
+        with self._lock:
+            self._events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": self._pid,
+                    "tid": track,
+                    "args": {"name": name},
+                }
+            )
+
+
+@contextmanager
+def record(path: str | None) -> Iterator[Tracer | None]:
+    """Trace the block and write the trace to `path`; does nothing if `path` is None."""
+    if path is None:
+        yield None
+        return
+    tracer = Tracer(path)
+    token = _tracer.set(tracer)
+    try:
+        yield tracer
+    finally:
+        _tracer.reset(token)
+        tracer.write()
+
+
+def enabled() -> bool:
+    return _tracer.get() is not None
+
+
+@contextmanager
+def span(
+    name: str, category: str, *, own_track: bool = False, **args: Any
+) -> Iterator[dict[str, Any]]:
+    """
+    Trace the block as a span. The yielded dict holds the span's arguments and can
+    be added to from within the block, e.g. with the size of what it produced (see
+    also `annotate`). `own_track` puts the span (and the spans nested in it) on a
+    track of its own, for work that runs concurrently with the loop.
+    """
+    tracer = _tracer.get()
+    if tracer is None:
+        yield args
+        return
+    if own_track:
+        track = tracer.acquire_track()
+        token = _track.set(track)
+    args_token = _span_args.set(args)
+    start = tracer.now()
+    try:
+        yield args
+    finally:
+        tracer.add_span(name, category, start, args)
+        _span_args.reset(args_token)
+        if own_track:
+            _track.reset(token)
+            tracer.release_track(track)
+
+
+def annotate(**args: Any):
+    """Add arguments to the innermost span, if tracing."""
+    span_args = _span_args.get()
+    if span_args is not None:
+        span_args.update(args)
+
+
+def traced(function: Callable, name: str, category: str) -> Callable:
+    """Wrap a (synchronous) function so each call is traced as a span."""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with span(name, category):
+            return function(*args, **kwargs)
+
+    return wrapper
@@ -1,16 +1,30 @@
 import asyncio
+import json
+import logging
 import os
 import sys
-import json
-import base64
+import time
+import mimetypes
 
-from computer_use_demo.loop import sampling_loop, APIProvider
+from computer_use_demo import metrics
+from computer_use_demo.loop import sampling_loop, APIProvider, SamplingResponse
 from computer_use_demo.tools import ToolResult
-from anthropic.types.beta import BetaMessage, BetaMessageParam
-from anthropic import APIResponse
+from anthropic.types.beta import (
+    BetaContentBlock,
+    BetaMessageParam,
+    BetaTextDelta,
+)
+
+logger = logging.getLogger(__name__)
+
+# longer tool inputs (e.g. the text of a file being created) are cut short
+MAX_TOOL_INPUT_CHARS = 500
 
 
 async def main():
+    # LOG_LEVEL=DEBUG also prints every raw API response
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING"), format="%(message)s")
+
     # Set up your Anthropic API key and model
     api_key = os.getenv("ANTHROPIC_API_KEY", "YOUR_API_KEY_HERE")
     if api_key == "YOUR_API_KEY_HERE":
@@ -20,8 +34,9 @@ async def main():
     provider = APIProvider.ANTHROPIC
 
     # Check if the instruction is provided via command line arguments
-    if len(sys.argv) > 1:
-        instruction = " ".join(sys.argv[1:])
+    args = [arg for arg in sys.argv[1:] if arg not in ("--metrics", "--trace")]
+    if args:
+        instruction = " ".join(args)
     else:
         instruction = "Save an image of a cat to the desktop."
 
@@ -38,43 +53,73 @@ async def main():
     ]
 
     # Define callbacks (you can customize these)
-    def output_callback(content_block):
-        if isinstance(content_block, dict) and content_block.get("type") == "text":
-            print("Assistant:", content_block.get("text"))
+    def output_callback(content_block: BetaContentBlock | BetaTextDelta):
+        if content_block.type == "text_delta":
+            print(content_block.text, end="", flush=True)
+        elif content_block.type == "text":
+            # the text itself has already been printed as it streamed in
+            print()
+        elif content_block.type == "tool_use":
+            tool_input = json.dumps(content_block.input, ensure_ascii=False)
+            if len(tool_input) > MAX_TOOL_INPUT_CHARS:
+                tool_input = tool_input[:MAX_TOOL_INPUT_CHARS] + "..."
+            print(f"> Tool Use [{content_block.id}]: {content_block.name}", tool_input)
 
     def tool_output_callback(result: ToolResult, tool_use_id: str):
         if result.output:
             print(f"> Tool Output [{tool_use_id}]:", result.output)
         if result.error:
             print(f"!!! Tool Error [{tool_use_id}]:", result.error)
-        if result.base64_image:
+        if result.image:
             # Save the image to a file if needed
             os.makedirs("screenshots", exist_ok=True)
-            image_data = result.base64_image
-            with open(f"screenshots/screenshot_{tool_use_id}.png", "wb") as f:
-                f.write(base64.b64decode(image_data))
-            print(f"Took screenshot screenshot_{tool_use_id}.png")
+            extension = mimetypes.guess_extension(
+                result.image_media_type or "image/png"
+            )
+            with open(f"screenshots/screenshot_{tool_use_id}{extension}", "wb") as f:
+                f.write(result.image)
+            print(f"Took screenshot screenshot_{tool_use_id}{extension}")
 
-    def api_response_callback(response: APIResponse[BetaMessage]):
+    def api_response_callback(response: SamplingResponse):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("API Response:\n%s", response.raw_text)
+        usage = response.usage
+        first_token = (
+            f" (first token after {response.time_to_first_token:.2f}s)"
+            if response.time_to_first_token is not None
+            else ""
+        )
         print(
-            "\n---------------\nAPI Response:\n",
-            json.dumps(json.loads(response.text)["content"], indent=4),  # type: ignore
-            "\n",
+            f"Tokens: input={usage.input_tokens} output={usage.output_tokens} "
+            f"cache_read={usage.cache_read_input_tokens or 0} "
+            f"cache_write={usage.cache_creation_input_tokens or 0} "
+            f"in {response.elapsed:.2f}s{first_token}"
         )
 
+    # `--trace` writes a timeline of the run, to be opened in Perfetto
+    trace_path = None
+    if "--trace" in sys.argv:
+        trace_path = f"traces/trace_{time.strftime('%Y%m%d_%H%M%S')}.json"
+
     # Run the sampling loop
-    messages = await sampling_loop(
-        model="claude-3-5-sonnet-20241022",
-        provider=provider,
-        system_prompt_suffix="",
-        messages=messages,
-        output_callback=output_callback,
-        tool_output_callback=tool_output_callback,
-        api_response_callback=api_response_callback,
-        api_key=api_key,
-        only_n_most_recent_images=10,
-        max_tokens=4096,
-    )
+    try:
+        messages = await sampling_loop(
+            model="claude-3-5-sonnet-20241022",
+            provider=provider,
+            system_prompt_suffix="",
+            messages=messages,
+            output_callback=output_callback,
+            tool_output_callback=tool_output_callback,
+            api_response_callback=api_response_callback,
+            api_key=api_key,
+            only_n_most_recent_images=10,
+            max_tokens=4096,
+            stream=True,
+            trace_path=trace_path,
+        )
+    finally:
+        if trace_path:
+            print(f"Trace written to {trace_path}")
 
 
 if __name__ == "__main__":
@@ -82,3 +127,7 @@ if __name__ == "__main__":
         asyncio.run(main())
     except Exception as e:
         print(f"Encountered Error:\n{e}")
+    finally:
+        # `--metrics` prints where the time went when the run ends
+        if "--metrics" in sys.argv:
+            print("\n---------------\nMetrics:\n" + metrics.summary())